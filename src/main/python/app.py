@@ -1,35 +1,159 @@
 #pylint: disable=invalid-name,missing-docstring
 
+import os
 import time
-import json
+import queue
 import threading
 import multiprocessing
+import multiprocessing.connection
 from collections import defaultdict
 
+import numpy as np
+
 try:
     import jack
     HAS_JACK = True
 except ImportError:
     HAS_JACK = False
 
-from pythonosc import udp_client
+from pythonosc import udp_client, osc_bundle_builder, osc_message_builder
 import mido
-from mido import Message, MidiFile, MidiTrack, MetaMessage
+from mido import MidiFile
 
-from core import Instrument, DEFAULT_SECTION_PARAMS
-from network import NetworkEngine
+from core import Instrument, DEFAULT_SECTION_PARAMS, batch, addChangeListener, removeChangeListener
+from clock import PlaybackClock, TICKS_PER_BEAT, SPIN_NS
+from network import NetworkEngine, MAX_BATCH_SIZE, MAX_BATCH_WAIT
+from scheduler import RequestScheduler
+from speculation import CandidatePool, SPECULATIVE_CANDIDATES
+from transport import SharedTransport, RING_SIZE
+from project import saveProject, openProject
+from journal import ProjectJournal, recoverProject
 
 APP_NAME = "musAIc (v0.9.0.)"
 
 CLIENT_ADDR = '127.0.0.1'
 CLIENT_PORT = 57120
 
+# send all OSC messages of a tick in one bundle
+OSC_BUNDLE = True
+# seconds ahead that OSC bundles are timetagged (0 to play immediately)
+OSC_LATENCY = 0
+
 STOPPED = 0
 PLAYING = 1
 
+TICKS_PER_BAR = TICKS_PER_BEAT * 4
+
+# Number of NetworkEngine processes, each with their own copy of the network
+NETWORK_WORKERS = max(1, multiprocessing.cpu_count() - 1)
+
+# Longest time (s) the Engine waits for an event before checking the workers are alive
+HEALTH_CHECK_INTERVAL = 1
+
+# send requests and results between Engine and the network workers through shared
+# memory (otherwise they are pickled through the queues)
+SHARED_MEMORY = True
+
+# save projects in the binary format (see project.py) instead of JSON, both can be
+# opened
+BINARY_PROJECTS = True
+
+
+# Playback timeline: one row per MIDI event, sorted by absolute tick (bar*TICKS_PER_BAR + tick)
+TIMELINE_DTYPE = np.dtype([
+    ('tick', 'i8'),
+    ('type', 'u1'),
+    ('chan', 'u1'),
+    ('note', 'i2'),
+    ('velocity', 'u1'),
+])
+EVENT_TYPES = ('note_off', 'note_on')
+EVENT_CODES = {t: i for i, t in enumerate(EVENT_TYPES)}
+
+
+def compileTimeline(bars):
+    ''' Converts {bar: {tick: [MIDI messages]}} to a timeline array. Events on the same
+    tick keep their order '''
+    rows = [(n*TICKS_PER_BAR + t, EVENT_CODES[msg.type], msg.channel, msg.note, msg.velocity)
+            for n, ticks in bars.items()
+            for t, msgs in ticks.items()
+            for msg in msgs if msg.type in EVENT_CODES]
+
+    timeline = np.array(rows, dtype=TIMELINE_DTYPE)
+    return timeline[np.argsort(timeline['tick'], kind='stable')]
 
-def convertMidiToOsc(msg):
-    return (msg.type, (msg.channel, msg.note, msg.velocity))
+
+def spliceTimeline(timeline, bars):
+    ''' Returns timeline with the events of each bar in bars ({bar: {tick: [MIDI
+    messages]}}) replaced (an empty dictionary clears the bar) '''
+    pieces = []
+    done = 0
+    for n in sorted(bars):
+        start, end = np.searchsorted(timeline['tick'], [n*TICKS_PER_BAR, (n+1)*TICKS_PER_BAR])
+        pieces.append(timeline[done:start])
+        pieces.append(compileTimeline({n: bars[n]}))
+        done = end
+    pieces.append(timeline[done:])
+
+    return np.concatenate(pieces)
+
+
+class OscOutput():
+    '''
+    Sends OSC messages over UDP. Messages are collected until flush(), which sends
+    them all in one bundle, timetagged latency seconds in the future (if latency > 0).
+    If bundle is False, messages are sent one by one as they are added.
+    '''
+
+    def __init__(self, addr=CLIENT_ADDR, port=CLIENT_PORT, bundle=OSC_BUNDLE, latency=OSC_LATENCY):
+        self.client = udp_client.UDPClient(addr, port)
+        self.bundle = bundle
+        self.latency = latency
+
+        self.messages = []
+
+        self.packets = 0
+        self.bytes = 0
+
+    def sendMessage(self, address, args):
+        msg = osc_message_builder.OscMessageBuilder(address=address)
+        if not isinstance(args, (list, tuple)):
+            args = [args]
+        for arg in args:
+            msg.add_arg(arg)
+
+        self.messages.append(msg.build())
+
+        if not self.bundle:
+            self.flush()
+
+    def flush(self):
+        ''' Sends all collected messages '''
+        if not self.messages:
+            return
+
+        if self.bundle and (len(self.messages) > 1 or self.latency > 0):
+            if self.latency > 0:
+                timestamp = time.time() + self.latency
+            else:
+                timestamp = osc_bundle_builder.IMMEDIATELY
+
+            bundle = osc_bundle_builder.OscBundleBuilder(timestamp)
+            for msg in self.messages:
+                bundle.add_content(msg)
+            packets = [bundle.build()]
+        else:
+            packets = self.messages
+
+        self.messages = []
+
+        for packet in packets:
+            self.client.send(packet)
+            self.packets += 1
+            self.bytes += packet.size
+
+    def getStats(self):
+        return {'packets': self.packets, 'bytes': self.bytes}
 
 
 class MediaPlayer(threading.Thread):
@@ -42,19 +166,22 @@ class MediaPlayer(threading.Thread):
         self.msgQueue = msgQueue
         self.clockVar = clockVar
 
-        # {barNum: {tick: [('/addr', (args))]}}
-        #self.messages = dict()
-        self.instrumentMessages = dict()
         self.instrumentChannels = dict()
         self.instrumentOctave = dict()
         self.instrumentMute = dict()
 
-        self.client = udp_client.SimpleUDPClient(CLIENT_ADDR, CLIENT_PORT)
+        # {id: timeline of the instrument's MIDI events, without transposition}, compiled
+        # when the events arrive (only the changed bars for patches)
+        self.instrumentTimelines = dict()
+
+        self.client = OscOutput(CLIENT_ADDR, CLIENT_PORT)
         self.sendOscClock = True
         self.sendMidiClock = True
         self.bpm = 80
         self.globalTranspose = 0
 
+        self.clock = PlaybackClock(self.bpm)
+
         self.stopRequest = multiprocessing.Event()
         self.playing = multiprocessing.Event()
         self.stopping = False
@@ -84,82 +211,126 @@ class MediaPlayer(threading.Thread):
 
     def run(self):
         while not self.stopRequest.is_set():
-
             self.checkMessages()
 
             if self.playing.is_set():
-                # --- Starting playback
-                # --- Before measure starts
-                print('[MediaPlayer]', 'Bar', self.clockVar[0], self.port)
+                self.play()
+            else:
+                self.playing.wait(0.1)
+
+    def play(self):
+        ''' Plays from the current bar until playback stops. Ticks are counted from the
+        start of playback, and the events of each bar are prepared before it starts, so
+        only the dispatch of events is done when a tick is due '''
+        self.clock.start()
+        tick = 0
+        events = self.prepareBar(self.clockVar[0])
+        cursor = 0
+
+        while not self.stopRequest.is_set():
+            self.clock.waitUntil(tick)
 
-                tickTime = (60/self.bpm)/24
+            # --- During measure
+            barTick = tick % TICKS_PER_BAR
+            with self.clockVar:
+                self.clockVar[1] = barTick
 
-                # measures = (instrumentID, {tick: [midiMessages]})
-                # for each instrument at current bar number
-                measures = [(id_, m.get(self.clockVar[0], dict()))
-                            for id_, m in self.instrumentMessages.items() if not
-                            self.instrumentMute[id_]]
+            if self.sendOscClock and self.osc:
+                self.client.sendMessage('/clock', barTick)
 
-                clockOn = time.time()
+            if self.sendMidiClock and self.midi and self.port:
+                self.port.send(mido.Message('clock'))
 
-                # --- During measure
-                for tick in range(24 * 4):
-                    with self.clockVar:
-                        self.clockVar[1] = tick
+            while cursor < len(events) and events[cursor][0] <= barTick:
+                _, type_, chan, note, velocity = events[cursor]
+                self.sendEvent(EVENT_TYPES[type_], chan, note, velocity)
+                cursor += 1
 
-                    if self.sendOscClock and self.osc:
-                        self.client.send_message('/clock', tick)
+            self.client.flush()
 
-                    if self.sendMidiClock and self.midi and self.port:
-                        self.port.send(mido.Message('clock'))
+            tick += 1
 
-                    for measure in measures:
-                        id_ = measure[0]
-                        for msg in measure[1].get(tick, []):
-                            nn = msg.note + (12*self.instrumentOctave[measure[0]]) + self.globalTranspose
-                            print(nn, msg)
-                            self.sendOut(msg.copy(note=nn))
+            # --- After measure
+            if barTick == TICKS_PER_BAR - 1:
+                if not self.nextBar():
+                    return
+                events = self.prepareBar(self.clockVar[0])
+                cursor = 0
 
-                    if self.stopRequest.is_set():
-                        return
+            # handle messages until the next tick is almost due
+            self.checkMessages(deadline=self.clock.tickTime(tick) - SPIN_NS)
 
-                    nextTime = clockOn + (tick+1)*tickTime
-                    time.sleep(max(0, nextTime - time.time()))
+    def prepareBar(self, n):
+        ''' Returns the events of bar n of the unmuted instruments (transposed), as a sorted
+        list of (tick, type, chan, note, velocity) where tick is from the start of the bar.
+        Only the rows of bar n are taken from each instrument's timeline '''
+        parts = []
+        for id_, timeline in self.instrumentTimelines.items():
+            if self.instrumentMute.get(id_, False):
+                continue
 
-                # --- After measure
-                with self.clockVar.get_lock():
-                    next_bar = self.clockVar[0] + 1
+            start, end = np.searchsorted(timeline['tick'], [n*TICKS_PER_BAR, (n+1)*TICKS_PER_BAR])
+            if start == end:
+                continue
 
-                    if self.loop['loop']:
-                        if next_bar >= self.loop['end']:
-                            next_bar = self.loop['start']
-                            self.allOff()
+            part = timeline[start:end].copy()
+            part['note'] += 12*self.instrumentOctave.get(id_, 0) + self.globalTranspose
+            parts.append(part[(part['note'] >= 0) & (part['note'] < 128)])
 
-                            if self.jack:
-                                self.setJackTransportPosition(next_bar)
-                            if self.midi:
-                                self.setMidiSongPosition(next_bar)
+        if not parts:
+            return []
 
-                    with self.clockVar:
-                        self.clockVar[0] = next_bar
-                        self.clockVar[1] = 0
+        events = np.concatenate(parts)
+        events = events[np.argsort(events['tick'], kind='stable')]
+        events['tick'] -= n*TICKS_PER_BAR
+        return events.tolist()
 
-                # --- Stopping playback
-                if self.clockVar[2] == 0:
-                    print('[MediaPlayer]', 'stopping...')
-                    if self.jack:
-                        self.jackClient.transport_stop()
-                    if self.midi and self.port:
-                        print('stopping MIDI')
-                        self.port.send(mido.Message('stop'))
-                    if self.osc:
-                        self.client.send_message('/clockStop', 1)
+    def nextBar(self):
+        ''' Moves the clock to the next bar. Returns False if playback has stopped '''
+        with self.clockVar.get_lock():
+            next_bar = self.clockVar[0] + 1
+
+            if self.loop['loop']:
+                if next_bar >= self.loop['end']:
+                    next_bar = self.loop['start']
                     self.allOff()
-                    self.stopping = False
 
-            else:
-                time.sleep(0.1)
+                    if self.jack:
+                        self.setJackTransportPosition(next_bar)
+                    if self.midi:
+                        self.setMidiSongPosition(next_bar)
+
+            with self.clockVar:
+                self.clockVar[0] = next_bar
+                self.clockVar[1] = 0
+
+        # --- Stopping playback
+        if self.clockVar[2] == 0:
+            print('[MediaPlayer]', 'stopping...')
+            if self.jack:
+                self.jackClient.transport_stop()
+            if self.midi and self.port:
+                print('stopping MIDI')
+                self.port.send(mido.Message('stop'))
+            if self.osc:
+                self.client.sendMessage('/clockStop', 1)
+            self.allOff()
+            self.stopping = False
+            return False
+
+        return True
+
+    def setBpm(self, bpm):
+        self.bpm = bpm
+        self.clock.setBpm(bpm)
 
+    def getTimingStats(self):
+        ''' Lateness of ticks since playback started (see PlaybackClock.getStats) '''
+        return self.clock.getStats()
+
+    def getOutputStats(self):
+        ''' Number of OSC packets and bytes sent by the current client '''
+        return self.client.getStats()
 
     def join(self, timeout=None):
         self.stopRequest.set()
@@ -172,23 +343,27 @@ class MediaPlayer(threading.Thread):
         super(MediaPlayer, self).join(timeout)
 
     def sendOut(self, msg):
+        self.sendEvent(msg.type, msg.channel, msg.note, msg.velocity)
+
+    def sendEvent(self, type_, chan, note, velocity):
         if self.client and self.osc:
-            self.client.send_message(*convertMidiToOsc(msg))
+            self.client.sendMessage(type_, (chan, note, velocity))
 
         if self.midi and self.port:
-            self.port.send(msg)
+            self.port.send(mido.Message(type_, channel=chan, note=note, velocity=velocity))
 
-        if msg.type == 'note_on':
-            self.noteOns[msg.channel].add(msg.note)
-        elif msg.type == 'note_off':
+        if type_ == 'note_on':
+            self.noteOns[chan].add(note)
+        elif type_ == 'note_off':
             try:
-                self.noteOns[msg.channel].remove(msg.note)
+                self.noteOns[chan].remove(note)
             except KeyError:
                 pass
 
-    def checkMessages(self):
+    def checkMessages(self, deadline=None):
+        ''' Handles queued messages, until time.perf_counter_ns() passes deadline '''
         try:
-            while True:
+            while deadline is None or time.perf_counter_ns() < deadline:
                 # format (id, messages)
                 msg = self.msgQueue.get(block=False)
                 try:
@@ -198,12 +373,18 @@ class MediaPlayer(threading.Thread):
                     print('[MediaPlayer]', 'Message in wrong format:', msg)
                     continue
 
-                if mType != 'midi':
+                if mType not in ('midi', 'midi_patch'):
                     print('[MediaPlayer]', 'New message:', mType, data)
 
                 if mType == 'midi':
                     # recieved midi data...
-                    self.instrumentMessages[data[0]] = data[1]
+                    self.instrumentTimelines[data[0]] = compileTimeline(data[1])
+                elif mType == 'midi_patch':
+                    # recieved changed bars of midi data...
+                    timeline = self.instrumentTimelines.get(data[0])
+                    if timeline is None:
+                        timeline = np.empty(0, dtype=TIMELINE_DTYPE)
+                    self.instrumentTimelines[data[0]] = spliceTimeline(timeline, data[1])
                 elif mType == 'chan':
                     # recieve channel change...
                     self.instrumentChannels[data[0]] = data[1]
@@ -215,7 +396,7 @@ class MediaPlayer(threading.Thread):
                     self.instrumentOctave[data[0]] = data[1]
                 elif mType == 'bpm':
                     # change of BPM...
-                    self.bpm = data
+                    self.setBpm(data)
                 elif mType == 'global_transpose':
                     # change of global transposition...
                     self.globalTranspose = data
@@ -223,7 +404,10 @@ class MediaPlayer(threading.Thread):
                     print('[MediaPlayer]', 'client options set', data)
                     addr = data[0]
                     port = data[1]
-                    self.client = udp_client.SimpleUDPClient(addr, port)
+                    bundle = data[3] if len(data) > 3 else OSC_BUNDLE
+                    latency = data[4] if len(data) > 4 else OSC_LATENCY
+                    self.client.flush()
+                    self.client = OscOutput(addr, port, bundle, latency)
                     self.sendOscClock = data[2]
                 elif mType == 'midi_port_setting':
                     print('[MediaPlayer]', 'midi options set:', data)
@@ -272,7 +456,8 @@ class MediaPlayer(threading.Thread):
             self.setJackTransportPosition(self.clockVar[0])
 
         if self.osc and self.sendOscClock:
-            self.client.send_message('/clockStart', 1)
+            self.client.sendMessage('/clockStart', 1)
+            self.client.flush()
 
         self.playing.set()
 
@@ -282,7 +467,7 @@ class MediaPlayer(threading.Thread):
 
         status, position = self.jackClient.transport_query()
         if 'beats_per_minute' in position:
-            self.bpm = position['beats_per_minute']
+            self.setBpm(position['beats_per_minute'])
 
         seconds_per_measure = (60 * 4) / self.bpm
         location = int(position['frame_rate'] * seconds_per_measure * n)
@@ -303,7 +488,7 @@ class MediaPlayer(threading.Thread):
 
     def allOff(self):
         if self.client and self.osc:
-            self.client.send_message('/panic', 0)
+            self.client.sendMessage('/panic', 0)
         #if self.port:
         #    self.port.panic() # doesn't work??
 
@@ -313,6 +498,9 @@ class MediaPlayer(threading.Thread):
                 print(note, chan)
                 self.sendOut(mido.Message('note_off', channel=chan, note=note))
 
+        if self.client:
+            self.client.flush()
+
         self.noteOns = defaultdict(set)
 
 
@@ -327,22 +515,27 @@ class Engine(threading.Thread):
         self.bpm = 80
 
         self.msgQueue = multiprocessing.Queue()
-        self.requests = []
+        self.scheduler = RequestScheduler(readyCallback=self.wake)
         self.netRequestQueue = multiprocessing.Queue()
-        self.netReturnQueue = multiprocessing.Queue()
+        # (results are put synchronously, so they are there once the doorbell rings)
+        self.netReturnQueue = multiprocessing.SimpleQueue()
 
         self.callbacks = {
             'network_initialised': set(),
             'instrument_added': set(),
             'section_added': set(),
-            'network_queue_empty': set()
+            'network_queue_empty': set(),
+            # (measures, sections) changed in a transaction()
+            'measures_changed': set()
         }
 
         self.oscOptions = {
             'addr': CLIENT_ADDR,
             'port': CLIENT_PORT,
             'clock': True,
-            'send': True
+            'send': True,
+            'bundle': OSC_BUNDLE,
+            'latency': OSC_LATENCY
         }
 
         self.midiOptions = {
@@ -363,26 +556,99 @@ class Engine(threading.Thread):
         self.clockVar = multiprocessing.Array('i', [0, 0, 0])
         self.player = MediaPlayer(self.msgQueue, self.clockVar)
 
-        self.networkEngine = NetworkEngine(self.netRequestQueue,
-                                           self.netReturnQueue,
-                                           resources_path=resources_path,
-                                           init_callbacks=kwargs.get('init_callback', None))
+        numWorkers = max(1, kwargs.get('network_workers', NETWORK_WORKERS))
+
+        # number of (non speculative) requests sent to the network without a result yet,
+        # and the most there can be (the rest wait, so the bars played next can go first)
+        self.inFlight = 0
+        self.maxInFlight = max(1, kwargs.get('max_in_flight',
+                                             numWorkers * kwargs.get('max_batch_size', MAX_BATCH_SIZE)))
+        # results dropped as their requests were superseded or cancelled
+        self.staleResults = 0
+
+        if kwargs.get('shared_memory', SHARED_MEMORY):
+            # (room for all requests in flight, and for the stop messages of the workers)
+            self.transport = SharedTransport(max(RING_SIZE, self.maxInFlight + 2*numWorkers))
+            self.doorbellReader = self.transport.doorbellReader
+            doorbellWriter = self.transport.doorbellWriter
+        else:
+            self.transport = None
+            # rung by the workers after they return messages
+            self.doorbellReader, doorbellWriter = multiprocessing.Pipe(duplex=False)
+
+        self.networkEngines = [
+            NetworkEngine(self.netRequestQueue,
+                          self.netReturnQueue,
+                          resources_path=resources_path,
+                          init_callbacks=kwargs.get('init_callback', None),
+                          max_batch_size=kwargs.get('max_batch_size', MAX_BATCH_SIZE),
+                          max_batch_wait=kwargs.get('max_batch_wait', MAX_BATCH_WAIT),
+                          worker_id=i,
+                          result_cache=kwargs.get('result_cache', None),
+                          transport=self.transport,
+                          doorbell=doorbellWriter)
+            for i in range(numWorkers)
+        ]
+
+        # alternative versions of the selected section, generated while the network is idle
+        self.speculativeCandidates = kwargs.get('speculative_candidates', SPECULATIVE_CANDIDATES)
+        self.candidatePool = None
+
+        # {workerID: status}, where status is 'loading', 'loaded', 'failed' or 'stopped'
+        self.networkStatus = {i: 'loading' for i in range(numWorkers)}
+        self.lastHealthCheck = time.time()
+
+        # autosave journal of the project (see startAutosave), the measureCount of each
+        # section (insID, sectionID) when it was last journaled, whether changes are
+        # journaled (not while loading), and whether a change could not be journaled
+        # (so a new snapshot has to be written)
+        self.journal = None
+        self.journalCounts = dict()
+        self.journalLock = threading.Lock()
+        self.journalPaused = False
+        self.journalFailed = False
 
         self.status = STOPPED
         self.stopRequest = multiprocessing.Event()
 
+        # written to by wake() to interrupt the wait in run()
+        self.wakeReader, self.wakeWriter = multiprocessing.Pipe(duplex=False)
+        self.wakeLock = threading.Lock()
+        self.wakePending = False
+
         #mido.set_backend('mido.backends.pygame')
         mido.set_backend('mido.backends.rtmidi')
 
         self.player.start()
-        self.networkEngine.start()
+        for networkEngine in self.networkEngines:
+            networkEngine.start()
 
     def run(self):
         while not self.stopRequest.is_set():
             self.checkSendMessages()
             self.checkReturnedMessages()
-
-            time.sleep(1/30)
+            self.checkSpeculation()
+            self.checkNetworkHealth()
+
+            # sleep until a result is returned or a request becomes ready...
+            waitFor = [self.doorbellReader, self.wakeReader]
+            ready = multiprocessing.connection.wait(waitFor, timeout=HEALTH_CHECK_INTERVAL)
+            if self.wakeReader in ready:
+                self.clearWake()
+
+    def wake(self):
+        ''' Interrupts the wait in run(), e.g. when new requests are ready '''
+        with self.wakeLock:
+            if self.wakePending:
+                return
+            self.wakePending = True
+        self.wakeWriter.send_bytes(b'\0')
+
+    def clearWake(self):
+        with self.wakeLock:
+            while self.wakeReader.poll():
+                self.wakeReader.recv_bytes()
+            self.wakePending = False
 
     def call(self, event, *args):
         for func in self.callbacks[event]:
@@ -392,56 +658,390 @@ class Engine(threading.Thread):
         self.callbacks[event].add(func)
 
     def checkSendMessages(self):
-        # find all requests that meet requirements and send to network...
-        unsentMsgs = []
-        for msg in self.requests:
-            if not any([b.isEmpty() for b in msg['requires']]):
-                #print('[Engine]', 'adding measure', msg['measure_address'], 'to requests queue')
-                payload = {
-                    'request': msg['request'],
-                    'measure_address': msg['measure_address']
-                }
-                self.netRequestQueue.put(payload)
-            else:
-                unsentMsgs.append(msg)
-        self.requests = unsentMsgs
+        # send the requests that have their requirements met to network,
+        # those closest to the playhead first...
+        room = self.maxInFlight - self.inFlight
+        if room <= 0 or not self.scheduler.hasReady():
+            return
+
+        for msg in self.scheduler.popReady(limit=room, priority=self.getRequestPriority()):
+            #print('[Engine]', 'adding measure', msg['measure_address'], 'to requests queue')
+            payload = {
+                'request': msg['request'],
+                'measure_address': msg['measure_address'],
+                'epoch': msg.get('epoch')
+            }
+            self.sendRequest(payload)
+            self.inFlight += 1
+
+    def getRequestPriority(self):
+        ''' Returns a function giving the priority of a request (lowest first): how soon
+        the playhead reaches the earliest bar its measure is at '''
+        positions = defaultdict(list)
+        for instrument in self.instruments.values():
+            for n, m in enumerate(instrument.track.flatMeasures):
+                if m:
+                    positions[m].append(n)
+
+        def priority(requestMsg):
+            bars = positions.get(requestMsg['measure'])
+            if not bars:
+                return (3, 0)
+            return min(self.getPlayheadDistance(n) for n in bars)
+
+        return priority
+
+    def getPlayheadDistance(self, n):
+        ''' How soon bar n will be played, as (group, bars): the bars ahead of the playhead
+        (inside the loop region when looping) come first, then the bars outside the
+        loop region, then the bars already passed '''
+        current = self.clockVar[0]
+
+        if self.loop['loop'] and self.loop['end'] > self.loop['start']:
+            start, end = self.loop['start'], self.loop['end']
+            if start <= n < end:
+                if start <= current < end:
+                    return (0, (n - current) % (end - start))
+                return (0, n - start)
+            return (1, abs(n - current))
+
+        if n >= current:
+            return (0, n - current)
+        return (2, current - n)
+
+    def checkSpeculation(self):
+        # generate the next bar of a candidate if the network has nothing else to do...
+        pool = self.candidatePool
+        if pool is None or self.inFlight > 0 or len(self.scheduler) > 0:
+            return
+
+        pool.validate()
+        nextRequest = pool.nextRequest()
+        if nextRequest is None:
+            return
+
+        token, request = nextRequest
+        self.sendRequest({'request': request, 'measure_address': None, 'speculative': token})
+
+    def setSelectedSection(self, insID=None, sectionID=None):
+        ''' Sets the section to generate alternative versions of while the network is
+        idle, so that regenerating it is instant. None to stop '''
+        if insID is None or not self.speculativeCandidates:
+            self.setCandidatePool(None)
+            return
+
+        instrument = self.instruments[insID]
+        section = instrument.sections[sectionID]
+
+        if section.type_ != 'ai':
+            self.setCandidatePool(None)
+        elif self.candidatePool is None or self.candidatePool.section is not section:
+            self.setCandidatePool(CandidatePool(instrument, section, self.speculativeCandidates))
+
+    def setCandidatePool(self, pool):
+        # (changes to the section wake the loop, to start generating new candidates)
+        if self.candidatePool is not None:
+            self.candidatePool.section.removeCallback(self.wake)
+
+        self.candidatePool = pool
+
+        if pool is not None:
+            pool.section.addCallback(self.wake)
+            self.wake()
+
+    def useCandidate(self, instrument, section):
+        ''' Sets the notes of section to a pre-generated version. Returns False if there
+        is none (or the section still has bars being generated) '''
+        pool = self.candidatePool
+        if pool is None or pool.section is not section:
+            return False
+
+        candidate = pool.take()
+        if candidate is None:
+            return False
+
+        # (the candidate replaces any bars of the section still being generated)
+        self.cancelRequests(instrument.id_, section.id_)
+
+        with self.transaction():
+            for measureID, (notes, seed) in candidate.items():
+                section.measures[measureID].setNotes(notes, seed)
+
+        # (start generating the next candidate)
+        self.wake()
+        return True
+
+    def transaction(self):
+        ''' Context in which changes to the instruments update their tracks (and MIDI
+        output) once, at the end, followed by a single 'measures_changed' event '''
+        return batch(lambda measures, sections: self.call('measures_changed', measures, sections))
+
+    def sendRequest(self, payload):
+        if self.transport is not None:
+            self.transport.sendRequest(payload, self.netRequestQueue)
+        else:
+            self.netRequestQueue.put(payload)
 
     def checkReturnedMessages(self):
-        # check for any returned messages...
-        try:
-            result = self.netReturnQueue.get(False)
+        # collect all returned messages (clearing the doorbell first, so messages
+        # returned meanwhile ring it again)...
+        while self.doorbellReader.poll():
+            self.doorbellReader.recv_bytes()
+
+        results = []
+        while not self.netReturnQueue.empty():
+            results.append(self.netReturnQueue.get())
+
+        if self.transport is not None:
+            results.extend(self.transport.getResults())
+
+        updates = []
+        for result in results:
+            if 'status' in result:
+                self.setNetworkStatus(result['worker'], result['status'])
+                continue
+
+            if result.get('speculative') is not None:
+                if self.candidatePool is not None:
+                    self.candidatePool.addResult(result['speculative'], result['result'], result.get('seed'))
+                continue
+
+            self.inFlight = max(0, self.inFlight - 1)
+
             #print('[Engine]', 'recieved result for measure', result['measure_address'], ':')
             #print(result['result'])
-            self.getMeasure(*result['measure_address']).setNotes(result['result'])
+            measure = self.getMeasure(*result['measure_address'])
+            if measure and result.get('epoch') not in (None, measure.genEpoch):
+                # (superseded by a later request, or cancelled)
+                self.staleResults += 1
+                continue
 
-        except multiprocessing.queues.Empty:
-            pass
+            if measure:
+                updates.append((result['measure_address'][0], measure, result['result'],
+                                result.get('seed')))
+
+        if not updates:
+            return
+
+        # ...and set all the notes with a single track update per instrument
+        with self.transaction():
+            for _, measure, notes, seed in updates:
+                measure.setNotes(notes, seed)
+
+    def setNetworkStatus(self, workerID, status):
+        if self.networkStatus.get(workerID) == status:
+            return
+
+        print('[Engine]', 'network worker', workerID, status)
+        self.networkStatus[workerID] = status
+        self.call('network_initialised', workerID, status)
+
+    def checkNetworkHealth(self):
+        ''' Marks workers that have died as failed (at most once a second) '''
+        if time.time() - self.lastHealthCheck < HEALTH_CHECK_INTERVAL:
+            return
+        self.lastHealthCheck = time.time()
+
+        for networkEngine in self.networkEngines:
+            if not networkEngine.is_alive() and self.networkStatus[networkEngine.workerID] != 'stopped':
+                self.setNetworkStatus(networkEngine.workerID, 'failed')
+
+    def getNetworkStatus(self):
+        ''' Returns {workerID: {'status': str, 'alive': bool, 'loaded': bool}} '''
+        return {e.workerID: {'status': self.networkStatus[e.workerID],
+                             'alive': e.is_alive(),
+                             'loaded': e.isLoaded()}
+                for e in self.networkEngines}
+
+    def isNetworkLoaded(self):
+        return any(e.isLoaded() for e in self.networkEngines)
 
     def join(self, timeout=None):
         self.stopRequest.set()
+        self.wake()
         self.player.join(timeout)
-        self.networkEngine.join(timeout)
+
+        # stop all workers together, then wait for each...
+        for networkEngine in self.networkEngines:
+            networkEngine.stop()
+        for networkEngine in self.networkEngines:
+            networkEngine.join(timeout)
+            if networkEngine.is_alive():
+                print('[Engine]', 'terminating network worker', networkEngine.workerID)
+                networkEngine.terminate()
+            self.networkStatus[networkEngine.workerID] = 'stopped'
+
+        self.stopAutosave()
+
         super(Engine, self).join(timeout)
 
-    def sendInstrumentEvents(self, id_=None):
+    def startAutosave(self, path):
+        ''' Journals every change to the project from now on, to the snapshot at path
+        and its journal (see journal.py) '''
+        self.stopAutosave()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        print('[Engine]', 'autosaving to', path)
+        self.journal = ProjectJournal(path)
+        self.journal.start()
+        self.compactJournal()
+        addChangeListener(self.recordChanges)
+
+    def stopAutosave(self, discard=False):
+        ''' Stops journaling changes. If discard, the autosave files are deleted '''
+        if self.journal is None:
+            return
+
+        removeChangeListener(self.recordChanges)
+        with self.journalLock:
+            journal, self.journal = self.journal, None
+        journal.stop()
+        if discard:
+            journal.discard()
+
+    def recoverAutosave(self, path):
+        ''' Loads the project autosaved at path '''
+        try:
+            project = recoverProject(path)
+        except FileNotFoundError:
+            print('[Engine]', path, 'not found...')
+            return
+
+        self.loadProject(project)
+
+    def compactJournal(self):
+        ''' Writes a new snapshot of the whole project, the journal starts again. The
+        project can be changed by the other thread meanwhile: if that fails the
+        snapshot, it is tried again after the next change '''
+        with self.journalLock:
+            if self.journal is None:
+                return
+            try:
+                counts = {(ins.id_, section.id_): section.measureCount
+                          for ins in list(self.instruments.values())
+                          for section in list(ins.sections.values())}
+                data = self.getProjectData()
+            except RuntimeError as e:
+                print('[Engine]', 'autosave snapshot failed:', e)
+                self.journalFailed = True
+                return
+
+            self.journalCounts = counts
+            self.journalFailed = False
+            self.journal.compact(data)
+
+    def recordChanges(self, changes):
+        ''' Journals the sections (with the measures of each that changed) and the
+        track layouts changed in a batch (see core.batch()). Called on the thread that
+        made the changes, which also writes a new snapshot when one is due '''
+        if self.journal is None or self.journalPaused:
+            return
+        if not changes.sections and not changes.tracks:
+            return
+
+        try:
+            self.recordBatch(changes)
+        except RuntimeError as e:
+            # (the project was changed by the other thread meanwhile)
+            print('[Engine]', 'autosave failed:', e)
+            self.journalFailed = True
+
+        journal = self.journal
+        if journal is not None and (self.journalFailed or journal.needsCompaction()):
+            self.compactJournal()
+
+    def recordBatch(self, changes):
+        owners = {section: ins for ins in list(self.instruments.values())
+                  for section in list(ins.sections.values())}
+
+        with self.journalLock:
+            if self.journal is None:
+                return
+
+            for section in changes.sections:
+                instrument = owners.get(section)
+                if instrument is None:
+                    continue
+
+                # (measures added since the section was last journaled are included too)
+                key = (instrument.id_, section.id_)
+                added = self.journalCounts.get(key, 0)
+                self.journalCounts[key] = section.measureCount
+                measureIDs = [mID for mID, m in list(section.measures.items())
+                              if mID >= added or m in changes.measures]
+
+                self.journal.record({'type': 'section',
+                                     'instrument': instrument.id_,
+                                     'section': section.getData(measureIDs)})
+
+            for track in changes.tracks:
+                instrument = track.instrument
+                if self.instruments.get(instrument.id_) is not instrument:
+                    continue
+
+                self.journal.record({'type': 'track',
+                                     'instrument': instrument.id_,
+                                     'track': instrument.track.getData()})
+
+    def recordInstrument(self, insID):
+        ''' Journals the settings of the instrument (not its sections or track) '''
+        if self.journal is None or self.journalPaused:
+            return
+
+        instrument = self.instruments[insID]
+        with self.journalLock:
+            if self.journal is not None:
+                self.journal.record({'type': 'instrument',
+                                     'instrument': {'id': instrument.id_,
+                                                    'name': instrument.name,
+                                                    'chan': instrument.chan,
+                                                    'mute': instrument.mute,
+                                                    'octave_transpose': instrument.octave_transpose}})
+
+    def recordSettings(self):
+        if self.journal is None or self.journalPaused:
+            return
+
+        with self.journalLock:
+            if self.journal is not None:
+                self.journal.record({'type': 'settings',
+                                     'global_settings': {'bpm': self.bpm,
+                                                         'global_transpose': self.global_transpose}})
+
+    def sendInstrumentEvents(self, id_=None, full=False):
+        ''' Sends the bars of the instrument that changed since they were last sent
+        ('midi_patch'), or all of them if full ('midi'). If no id_ is given, then
+        all instruments are sent in full '''
         #print('[Engine]', 'sending instrument events for', id_)
         if id_ != None:
-            msg = {'type': 'midi'}
-            msg['data'] = (id_, self.instruments[id_].compileMidiMessages())
+            patch = self.instruments[id_].compileMidiPatch(full=full)
+            if full:
+                msg = {'type': 'midi',
+                       'data': (id_, {n: e for n, e in patch.items() if e})}
+            elif patch:
+                msg = {'type': 'midi_patch',
+                       'data': (id_, patch)}
+            else:
+                return
             self.msgQueue.put(msg)
         else:
             for instrument in self.instruments.values():
-                self.sendInstrumentEvents(instrument.id_)
+                self.sendInstrumentEvents(instrument.id_, full=True)
 
     def changeChannel(self, insID, newChan):
         #self.instruments[insID].chan = newChan
         self.instruments[insID].changeChannel(newChan)
+        self.recordInstrument(insID)
         msg = {'type': 'chan',
                'data': (insID, newChan)}
         self.msgQueue.put(msg)
 
     def changeMute(self, insID, mute=False):
         self.instruments[insID].mute = mute
+        self.recordInstrument(insID)
         msg = {'type': 'mute',
                'data': (insID, mute)}
         self.msgQueue.put(msg)
@@ -451,12 +1051,14 @@ class Engine(threading.Thread):
                'data': (insID, octave)}
         self.instrumentOctave[insID] = octave
         self.instruments[insID].octave_transpose = octave
+        self.recordInstrument(insID)
         self.msgQueue.put(msg)
 
     def setGlobalTranspose(self, transpose=0):
         msg = {'type': 'global_transpose',
                'data': transpose}
         self.global_transpose = transpose
+        self.recordSettings()
         self.msgQueue.put(msg)
 
     def setBPM(self, bpm=80):
@@ -465,17 +1067,28 @@ class Engine(threading.Thread):
         elif bpm > 300:
             bpm = 300
         self.bpm = bpm
+        self.recordSettings()
 
         msg = {'type': 'bpm',
                'data': bpm}
         self.msgQueue.put(msg)
 
-    def setClientOptions(self, addr, port, clock):
+    def setClientOptions(self, addr, port, clock, bundle=None, latency=None):
+        ''' bundle: send the OSC messages of each tick in one bundle
+            latency: seconds ahead the bundles are timetagged (0 to play immediately)
+        If bundle or latency are None, the current setting is kept '''
+        if bundle is None:
+            bundle = self.oscOptions['bundle']
+        if latency is None:
+            latency = self.oscOptions['latency']
+
         self.oscOptions['addr'] = addr
         self.oscOptions['port'] = port
         self.oscOptions['clock'] = clock
+        self.oscOptions['bundle'] = bundle
+        self.oscOptions['latency'] = latency
         msg = {'type': 'client_options',
-               'data': (addr, port, clock)}
+               'data': (addr, port, clock, bundle, latency)}
         self.msgQueue.put(msg)
 
     def setOscOut(self, out):
@@ -580,17 +1193,53 @@ class Engine(threading.Thread):
             return None
         return m
 
+    def getNetworkStats(self):
+        ''' Counters summed over all network workers '''
+        stats = defaultdict(int)
+        for networkEngine in self.networkEngines:
+            for k, v in networkEngine.getStats().items():
+                stats[k] += v
+        stats['stale_results'] = self.staleResults
+        if self.transport is not None:
+            stats.update(self.transport.getStats())
+        return dict(stats)
+
+    def getTimingStats(self):
+        ''' How late the MediaPlayer reached its ticks, in milliseconds '''
+        return self.player.getTimingStats()
+
+    def getOutputStats(self):
+        ''' Number of OSC packets and bytes sent '''
+        return self.player.getOutputStats()
+
     def addPendingRequest(self, requestMsg):
-        self.requests.append(requestMsg)
+        self.scheduler.addRequest(requestMsg)
 
-    def saveFile(self, fp='project.mus'):
-        if fp == '':
-            return
-        if fp[-4:] != '.mus':
-            fp = fp + '.mus'
+    def cancelRequests(self, insID=None, sectionID=None):
+        ''' Cancels the generation requests of a section (or of all the sections of
+        instrument insID, or of all instruments if insID is None). Requests not yet sent
+        are dropped, and results of those already sent are ignored. The measures are
+        left empty. Returns the number of measures cancelled '''
+        def match(address):
+            return ((insID is None or address[0] == insID) and
+                    (sectionID is None or address[1] == sectionID))
 
-        print('[Engine]', 'saving project as', fp, end='... ')
+        cancelled = self.scheduler.cancel(lambda msg: match(msg['measure_address']))
+        measures = {msg['measure'] for msg in cancelled}
+
+        # (and those sent to the network)
+        for id_, instrument in self.instruments.items():
+            for secID, section in instrument.sections.items():
+                if match((id_, secID)):
+                    measures.update(m for m in section.measures.values() if m.genRequestSent)
+
+        for m in measures:
+            m.genRequestSent = False
+            m.genEpoch += 1
 
+        return len(measures)
+
+    def getProjectData(self):
         data = {
             'global_settings': {
                 'bpm': self.bpm,
@@ -599,15 +1248,26 @@ class Engine(threading.Thread):
             'instruments': dict()
         }
 
-        for instrument in self.instruments.values():
+        for instrument in list(self.instruments.values()):
             ins_data = instrument.getData()
             data['instruments'][ins_data['id']] = ins_data
 
+        return data
+
+    def saveFile(self, fp='project.mus', binary=BINARY_PROJECTS):
+        if fp == '':
+            return
+        if fp[-4:] != '.mus':
+            fp = fp + '.mus'
+
+        print('[Engine]', 'saving project as', fp, end='... ')
+
+        data = self.getProjectData()
+
         #print('[Engine]', 'compiled dictionary, saving...')
 
         try:
-            with open(fp, 'w') as f:
-                json.dump(data, f, indent=4)
+            saveProject(fp, data, binary)
         except Exception as e:
             print('\n------------')
             print(data)
@@ -622,45 +1282,67 @@ class Engine(threading.Thread):
             return
 
         try:
-            with open(fp, 'r') as f:
-                data = json.load(f)
+            project = openProject(fp)
         except FileNotFoundError:
             print('[Engine]', fp, 'not found...')
             return
 
         print('[Engine]', 'opening file', fp, end='... \n')
 
+        self.loadProject(project)
+
+    def loadProject(self, project):
+        ''' Replaces the current project with project (see project.Project) '''
         # reset environment...
-        self.requests = []
+        self.scheduler.clear()
+        self.setCandidatePool(None)
         self.stopPlaying()
         self.setBarNumber(0)
 
-        while not self.msgQueue.empty():
-            _ = self.msgQueue.get()
+        # (the MediaPlayer may be taking messages from the queue meanwhile)
+        try:
+            while True:
+                self.msgQueue.get_nowait()
+        except queue.Empty:
+            pass
 
         self.instruments = dict()
 
         # load data...
         self.instrumentOctave = dict()
-        self.global_transpose = data['global_settings']['global_transpose']
-        self.bpm = data['global_settings']['bpm']
-
-        for insID, insData in data['instruments'].items():
-            id_ = int(insID)
-            print('  Loading instrument', id_)
-            instrument = Instrument(id_, insData['name'], insData['chan'], self)
-            instrument.setData(insData)
-            instrument.track.addCallback(lambda x: self.sendInstrumentEvents(id_))
-            self.instruments[id_] = instrument
-            self.changeChannel(id_, insData['chan'])
-            self.changeOctaveTranspose(id_, insData['octave_transpose'])
-            self.changeMute(id_, insData['mute'])
+        settings = project.getGlobalSettings()
+        self.global_transpose = settings['global_transpose']
+        self.bpm = settings['bpm']
+
+        # (the loaded project is autosaved as a whole afterwards)
+        self.journalPaused = True
+        try:
+            self.loadInstruments(project)
+        finally:
+            self.journalPaused = False
+
+        self.compactJournal()
 
         for ins in self.instruments.values():
             self.call('instrument_added', ins)
 
         print('  Loading complete')
 
+    def loadInstruments(self, project):
+        with self.transaction():
+            for insID in project.getInstrumentIDs():
+                # (the notes of each instrument are only read here)
+                insData = project.getInstrumentData(insID)
+                id_ = int(insID)
+                print('  Loading instrument', id_)
+                instrument = Instrument(id_, insData['name'], insData['chan'], self)
+                instrument.setData(insData)
+                instrument.track.addCallback(lambda x, id_=id_: self.sendInstrumentEvents(id_))
+                self.instruments[id_] = instrument
+                self.changeChannel(id_, insData['chan'])
+                self.changeOctaveTranspose(id_, insData['octave_transpose'])
+                self.changeMute(id_, insData['mute'])
+
     def importMidiFile(self, fp):
         if fp == '':
             return
@@ -700,33 +1382,7 @@ class Engine(threading.Thread):
             if instrument.mute:
                 continue
 
-            track = MidiTrack()
-
-            events = []
-            for n, m in enumerate(instrument.track.flatMeasures):
-                if not m:
-                    continue
-                for t, e in m.getMidiEvents().items():
-                    for msg in e:
-                        events.append((n*96+t, msg))
-
-            # sort by time, then note off events
-            events.sort(key=lambda x: (x[0], x[1].type))
-
-            track.append(MetaMessage('track_name', name=instrument.name))
-            for i, e in enumerate(events):
-                msg = e[1]
-                if i > 0:
-                    t = e[0] - events[i-1][0]
-                else:
-                    t = e[0]
-
-                #print(msg, t)
-                nn = msg.note + 12*self.instrumentOctave[instrument.id_] + self.global_transpose
-                track.append(msg.copy(time=t, note=nn))
-
-            track.append(MetaMessage('end_of_track'))
-            mid.tracks.append(track)
+            mid.tracks.append(instrument.exportMidiTrack(self.global_transpose))
 
         mid.save(fp)
 
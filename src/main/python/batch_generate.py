@@ -1,32 +1,53 @@
 #!/usr/bin/env python3
-
-import os
-import time
-import random
-from itertools import product
-
-from tqdm.auto import tqdm
-
-from app import Engine
-from core import DEFAULT_META_DATA, DEFAULT_SECTION_PARAMS, DEFAULT_AI_PARAMS
+#pylint: disable=invalid-name,missing-docstring
 
 '''
  == Batch Generator of Songs ==
 
- Produces N number of V varieties of songs (N*V total), in three folders:
+ Produces N songs for every combination of the PARAMETER_RANGES (each one with
+ randomly set meta_data values from META_DATA_RANGES), saved as MIDI files in
+
+   ROOT_PATH + 'melody_<job id>.mid', ...
+
+ where the job id is a hash of the song's parameters, meta data and seed. The job
+ list only depends on the seed, and every finished song is recorded in a manifest
+ (MANIFEST_NAME, JSON lines) in ROOT_PATH, so an interrupted run skips the finished
+ songs when restarted, and `--shard i/n` splits the jobs over several machines.
 
-   SAVE_ROOT + 'combined/', 'lead/', 'bass/'
+ No playback or MIDI/OSC output is started: songs are generated in parallel by a
+ pool of worker processes, each of which loads the network once. Run with
 
- where each variety is a combination of the PARAMETER_RANGES. Each one of N
- randomly sets the meta_data values.
+   $ python src/main/python/musaic.py batch --help
 
 '''
 
+import os
+import glob
+import json
+import time
+import random
+import hashlib
+import argparse
+import multiprocessing
+from functools import partial
+from itertools import product
+
+from mido import MidiFile
+
+from core import Instrument, DEFAULT_META_DATA, DEFAULT_SECTION_PARAMS, DEFAULT_AI_PARAMS, deriveSeed
+from network import loadNetwork, MAX_BATCH_SIZE
+from scheduler import RequestScheduler
+
 N = 10
-V = 20
+SEED = 0
 
 ROOT_PATH = os.path.expanduser('~/Projects/new_melodies')
 
+# manifest of finished songs, (suffixed with the shard when sharded)
+MANIFEST_NAME = 'manifest.jsonl'
+
+WORKERS = max(1, multiprocessing.cpu_count() - 1)
+
 PARAMETER_RANGES = {
     'length': [2, 4, 8],
     'loop_alt_len': [0, 1],
@@ -51,77 +72,266 @@ META_DATA_RANGES = {
     'pos': (0, 1)
 }
 
-if __name__ == '__main__':
-    print('STARTING')
-    app = Engine()
-    app.start()
+# network of the worker process, loaded by initWorker
+NETWORK = None
+NETWORK_ERROR = None
 
-    ##while not app.networkEngine.isLoaded():
-    ##    time.sleep(0.01)
 
-    time.sleep(10)
+class HeadlessEngine():
+    '''
+    Stands in for app.Engine when no playback is needed: holds the instruments and
+    generates their requested measures directly with the network.
+    '''
 
-    print(' == Creating instruments...')
-    #bass = app.addInstrument(name='bass')
-    lead = app.addInstrument(name='chords')
+    def __init__(self, network, max_batch_size=MAX_BATCH_SIZE):
+        self.network = network
+        self.maxBatchSize = max(1, max_batch_size)
 
-    print(' == Adding sections...')
-    #_, bass_sec = bass.newSection(chord_mode=1,
-    #                              octave=2,
-    #                              transpose_octave=-1,
-    #                              length=2,
-    #                              loop_num=8)
+        self.instruments = dict()
+        self.scheduler = RequestScheduler()
 
-    _, lead_sec = lead.newSection()
+    def addInstrument(self, name=None):
+        id_ = len(self.instruments)
+        if name is None:
+            name = 'INS ' + str(id_)
 
-    print(' == Entering space...')
+        instrument = Instrument(id_, name, id_+1, self)
+        self.instruments[id_] = instrument
+        return instrument
 
-    print(list(PARAMETER_RANGES.keys()))
+    def measuresAt(self, instrumentID, n):
+        return self.instruments[instrumentID].measuresAt(n)
 
-    counter = 0
-    for l, lal, sm, cm, ip in product(*PARAMETER_RANGES.values()):
+    def addPendingRequest(self, requestMsg):
+        self.scheduler.addRequest(requestMsg)
 
-        #print(l, 16//l, lal, sm, ip)
-        params = {**DEFAULT_SECTION_PARAMS, **DEFAULT_AI_PARAMS}
-        params['loop_num'] = 8//l
-        params['length'] = l
-        params['sample_mode'] = sm
-        params['loop_alt_len'] = lal
-        #params['lead'] = bass.id_
-        params['chord_mode'] = cm
-        params['octave'] = 4
+    def useCandidate(self, instrument, section):
+        # (no pre-generated bars)
+        return False
+
+    def generate(self):
+        ''' Generates all pending requests (in batches of requests whose required
+        measures are ready). Returns the number of bars generated '''
+        bars = 0
+        while True:
+            requestMsgs = self.scheduler.popReady()
+            if not requestMsgs:
+                break
+
+            for i in range(0, len(requestMsgs), self.maxBatchSize):
+                batch = requestMsgs[i:i+self.maxBatchSize]
+                results = self.network.generateBars([msg['request'] for msg in batch])
+                for requestMsg, result in zip(batch, results):
+                    requestMsg['measure'].setNotes(result, requestMsg['request'].get('seed'))
+
+            bars += len(requestMsgs)
+
+        if len(self.scheduler) > 0:
+            print('[HeadlessEngine]', len(self.scheduler), 'requests could not be generated')
+
+        return bars
+
+    def exportMidiFile(self, fp):
+        mid = MidiFile(ticks_per_beat=24, type=1)
+        for instrument in self.instruments.values():
+            if not instrument.mute:
+                mid.tracks.append(instrument.exportMidiTrack())
+        mid.save(fp)
 
-        lead_sec.changeParameter(**params)
-        #print(params)
 
-        for _ in range(N):
-            #bass_md = {**DEFAULT_META_DATA}
-            #for k, r in META_DATA_RANGES.items():
-            #    bass_md[k] = random.uniform(r[0], r[1])
-            #bass_sec.changeParameter(meta_data=bass_md)
+def makeJobs(n=N, seed=SEED):
+    ''' Returns a list of songs to generate: n for each combination of PARAMETER_RANGES.
+    Each job has its own seed, derived from seed, its parameters and its number within
+    the combination, so grids that overlap share jobs (and cached results) '''
+    jobs = []
+    for values in product(*PARAMETER_RANGES.values()):
+        params = dict(zip(PARAMETER_RANGES.keys(), values))
+        params['loop_num'] = 8 // params['length']
+        params['octave'] = 4
+
+        for i in range(n):
+            jobSeed = deriveSeed(seed, params, i)
+            jobRand = random.Random(jobSeed)
 
-            lead_md = {**DEFAULT_META_DATA}
+            meta_data = {**DEFAULT_META_DATA}
             for k, r in META_DATA_RANGES.items():
-                lead_md[k] = random.uniform(r[0], r[1])
-            lead_sec.changeParameter(meta_data=lead_md)
+                meta_data[k] = jobRand.uniform(r[0], r[1])
+
+            job = {'index': len(jobs), 'params': params, 'meta_data': meta_data, 'seed': jobSeed}
+            job['id'] = getJobID(job)
+            jobs.append(job)
+
+    return jobs
+
+
+def getJobID(job):
+    ''' Hash of the job's parameters, meta data and seed '''
+    key = json.dumps([job['params'], job['meta_data'], job['seed']], sort_keys=True)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+
+
+def getShard(jobs, shard=None):
+    ''' Every n-th job, starting from the i-th, where shard = (i, n) '''
+    if shard is None:
+        return jobs
+    i, n = shard
+    return jobs[i::n]
+
 
-            # regenerate...
-            #bass.requestGenerateMeasures(gen_all=True)
-            lead.requestGenerateMeasures(gen_all=True)
-            time.sleep(0.1)
+def parseShard(value):
+    ''' Parses 'i/n' (0 <= i < n) to (i, n) '''
+    try:
+        i, n = map(int, value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError('shard must be given as i/n, e.g. 0/4')
 
-            #while not bass_sec.isGenerated() or not lead_sec.isGenerated():
-            while not lead_sec.isGenerated():
-                time.sleep(0.1)
+    if n < 1 or not 0 <= i < n:
+        raise argparse.ArgumentTypeError('shard i/n must have 0 <= i < n')
 
-            app.exportMidiFile(os.path.abspath(os.path.join(ROOT_PATH, 'melody_{:04}.mid'.format(counter))), track_list=None)
-            #app.exportMidiFile(os.path.abspath(os.path.join(ROOT_PATH, 'bass/', 'bass_{:04}.mid'.format(counter))),
-            #                   track_list=[bass.id_])
-            #app.exportMidiFile(os.path.abspath(os.path.join(ROOT_PATH, 'chord/', 'chord_{:04}.mid'.format(counter))),
-            #                   track_list=[lead.id_])
+    return i, n
 
-            print(counter, 'songs generated')
 
-            counter += 1
+def getManifestPath(output, shard=None):
+    if shard is None:
+        return os.path.join(output, MANIFEST_NAME)
 
-    print('DONE')
+    name, ext = os.path.splitext(MANIFEST_NAME)
+    return os.path.join(output, '{}_{}of{}{}'.format(name, shard[0], shard[1], ext))
+
+
+def readFinishedJobs(output):
+    ''' Returns the IDs of the jobs recorded in any manifest in output whose MIDI
+    file still exists '''
+    name, ext = os.path.splitext(MANIFEST_NAME)
+    finished = set()
+
+    for fp in glob.glob(os.path.join(output, name + '*' + ext)):
+        with open(fp, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # (last line may be cut off by a crash)
+                    continue
+                if os.path.exists(os.path.join(output, record['path'])):
+                    finished.add(record['id'])
+
+    return finished
+
+
+def getOutputName(job):
+    return 'melody_{}.mid'.format(job['id'])
+
+
+def initWorker(resources_path=None, result_cache=None):
+    global NETWORK, NETWORK_ERROR
+    try:
+        NETWORK = loadNetwork(resources_path, result_cache=result_cache)
+    except Exception as e:
+        # (an exception here would make the pool restart the worker forever)
+        NETWORK_ERROR = e
+
+
+def runJob(job, output=ROOT_PATH):
+    ''' Generates and saves one song. Returns its manifest record, or the job with the
+    'error' that stopped it (so one failed song does not stop the whole run) '''
+    try:
+        return generateSong(job, output)
+    except Exception as e:
+        return {**job, 'error': '{}: {}'.format(type(e).__name__, e)}
+
+
+def generateSong(job, output=ROOT_PATH):
+    if NETWORK is None:
+        raise RuntimeError('network failed to load: {}'.format(NETWORK_ERROR))
+
+    start = time.time()
+
+    engine = HeadlessEngine(NETWORK)
+    lead = engine.addInstrument(name='chords')
+
+    _, lead_sec = lead.newSection()
+    lead_sec.changeParameter(**{**DEFAULT_SECTION_PARAMS, **DEFAULT_AI_PARAMS, **job['params'],
+                                'seed': job['seed']})
+    lead_sec.changeParameter(meta_data=job['meta_data'])
+
+    lead.requestGenerateMeasures(gen_all=True)
+    bars = engine.generate()
+
+    # (write to a temporary file first, so that no half written songs are left behind)
+    fp = os.path.join(output, getOutputName(job))
+    engine.exportMidiFile(fp + '.tmp')
+    os.replace(fp + '.tmp', fp)
+
+    return {**job, 'path': getOutputName(job), 'bars': bars, 'seconds': round(time.time() - start, 3)}
+
+
+def addArguments(parser):
+    parser.add_argument('-o', '--output', default=ROOT_PATH,
+                        help='directory to save the MIDI files to (default: %(default)s)')
+    parser.add_argument('-n', type=int, default=N,
+                        help='number of songs per parameter combination (default: %(default)s)')
+    parser.add_argument('-w', '--workers', type=int, default=WORKERS,
+                        help='number of worker processes (default: %(default)s)')
+    parser.add_argument('--resources', default=None,
+                        help='path to the network resources (default: src/main/resources/base/)')
+    parser.add_argument('--cache', default=None, metavar='PATH',
+                        help='sqlite file to keep generated bars in, shared between runs')
+    parser.add_argument('--seed', type=int, default=SEED,
+                        help='seed of the job list; keep the same to resume a run (default: %(default)s)')
+    parser.add_argument('--shard', type=parseShard, default=None, metavar='I/N',
+                        help='only generate every N-th song, starting from the I-th (0 <= I < N)')
+
+
+def run(args):
+    os.makedirs(args.output, exist_ok=True)
+
+    jobs = getShard(makeJobs(args.n, args.seed), args.shard)
+    finished = readFinishedJobs(args.output)
+    todo = [job for job in jobs if job['id'] not in finished]
+
+    print('[batch]', len(jobs), 'songs,', len(jobs) - len(todo), 'already finished')
+    if not todo:
+        return
+
+    workers = max(1, min(args.workers, len(todo)))
+    print('[batch]', 'generating', len(todo), 'songs with', workers, 'workers')
+
+    start = time.time()
+    bars = 0
+    failed = 0
+
+    with multiprocessing.Pool(workers, initializer=initWorker,
+                              initargs=(args.resources, args.cache)) as pool, \
+         open(getManifestPath(args.output, args.shard), 'a') as manifest:
+        results = pool.imap_unordered(partial(runJob, output=args.output), todo)
+        for done, record in enumerate(results, 1):
+            if 'error' in record:
+                # (not in the manifest, so it is tried again when the run is resumed)
+                failed += 1
+                print('[batch]', '{}/{}'.format(done, len(todo)), 'FAILED', record['id'], record['error'])
+                continue
+
+            manifest.write(json.dumps(record) + '\n')
+            manifest.flush()
+
+            bars += record['bars']
+            elapsed = time.time() - start
+            print('[batch]', '{}/{}'.format(done, len(todo)), record['path'],
+                  '({:.2f} songs/s, {:.1f} bars/s)'.format(done/elapsed, bars/elapsed))
+
+    elapsed = time.time() - start
+    print('[batch]', 'DONE:', len(todo) - failed, 'songs,', bars, 'bars in', round(elapsed, 2), 's')
+    if failed:
+        print('[batch]', failed, 'songs failed, run again to retry them')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Generate songs in batch, without playback')
+    addArguments(parser)
+    run(parser.parse_args(argv))
+
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    main()
@@ -0,0 +1,109 @@
+#pylint: disable=invalid-name,missing-docstring
+
+import json
+import sqlite3
+from collections import OrderedDict
+
+
+class LRUCache():
+    ''' Dictionary that holds at most maxsize items, discarding the least recently
+    used first. Counts hits and misses of get() '''
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        try:
+            value = self.items[key]
+        except KeyError:
+            self.misses += 1
+            return default
+
+        self.items.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self.items[key] = value
+        self.items.move_to_end(key)
+
+        while len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
+
+    def clear(self):
+        self.items = OrderedDict()
+
+    def getStats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.items)}
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+
+class ResultCache():
+    '''
+    Cache of JSON serializable values by string key, with an in memory LRU tier and
+    an optional sqlite file (path) that can be shared between processes and runs.
+    '''
+
+    def __init__(self, maxsize=1024, path=None):
+        self.memory = LRUCache(maxsize)
+        self.path = path
+        self.db = None
+
+        self.hits = 0
+        self.diskHits = 0
+        self.misses = 0
+
+        if path:
+            self.db = sqlite3.connect(path, timeout=30)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value TEXT)')
+            self.db.commit()
+
+    def get(self, key, default=None):
+        value = self.memory.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+
+        if self.db:
+            row = self.db.execute('SELECT value FROM results WHERE key = ?', (key,)).fetchone()
+            if row:
+                value = json.loads(row[0])
+                self.memory.put(key, value)
+                self.hits += 1
+                self.diskHits += 1
+                return value
+
+        self.misses += 1
+        return default
+
+    def put(self, key, value):
+        self.memory.put(key, value)
+
+        if self.db:
+            self.db.execute('INSERT OR REPLACE INTO results VALUES (?, ?)', (key, json.dumps(value)))
+            self.db.commit()
+
+    def close(self):
+        if self.db:
+            self.db.close()
+            self.db = None
+
+    def getStats(self):
+        return {'hits': self.hits, 'disk_hits': self.diskHits, 'misses': self.misses,
+                'size': len(self.memory)}
+
+    def __len__(self):
+        return len(self.memory)
+
+
+# EOF
@@ -0,0 +1,86 @@
+#pylint: disable=invalid-name,missing-docstring
+
+import time
+
+TICKS_PER_BEAT = 24
+
+# time before a deadline (ns) that is spent busy waiting rather than sleeping,
+# as time.sleep may overshoot by about a millisecond
+SPIN_NS = 1000000
+
+
+class PlaybackClock():
+    '''
+    Converts tick numbers to absolute deadlines on a timeline anchored at the start
+    of playback, so timing errors of one tick do not accumulate over the following
+    ticks. Records how late each tick was reached.
+    '''
+
+    def __init__(self, bpm=80, ticksPerBeat=TICKS_PER_BEAT):
+        self.ticksPerBeat = ticksPerBeat
+        self.nsPerTick = self.getNsPerTick(bpm)
+
+        # the timeline: anchorTick is due at anchorNs
+        self.anchorNs = time.perf_counter_ns()
+        self.anchorTick = 0
+        self.lastTick = -1
+
+        self.resetStats()
+
+    def getNsPerTick(self, bpm):
+        return 60 * 1000000000 / (bpm * self.ticksPerBeat)
+
+    def start(self, tick=0):
+        ''' Anchors tick to now '''
+        self.anchorNs = time.perf_counter_ns()
+        self.anchorTick = tick
+        self.lastTick = tick - 1
+        self.resetStats()
+
+    def setBpm(self, bpm):
+        ''' Changes the tempo from the next tick onwards (its deadline is unchanged) '''
+        nextTick = self.lastTick + 1
+        self.anchorNs = self.tickTime(nextTick)
+        self.anchorTick = nextTick
+        self.nsPerTick = self.getNsPerTick(bpm)
+
+    def tickTime(self, tick):
+        ''' perf_counter_ns() time that tick is due '''
+        return self.anchorNs + round((tick - self.anchorTick) * self.nsPerTick)
+
+    def waitUntil(self, tick):
+        ''' Blocks until tick is due, and returns how late (ns) it was reached '''
+        deadline = self.tickTime(tick)
+
+        remaining = deadline - time.perf_counter_ns()
+        if remaining > SPIN_NS:
+            time.sleep((remaining - SPIN_NS) / 1e9)
+
+        now = time.perf_counter_ns()
+        while now < deadline:
+            now = time.perf_counter_ns()
+
+        late = now - deadline
+        self.lastTick = tick
+
+        self.ticks += 1
+        self.totalLate += late
+        self.maxLate = max(self.maxLate, late)
+
+        return late
+
+    def resetStats(self):
+        self.ticks = 0
+        self.totalLate = 0
+        self.maxLate = 0
+
+    def getStats(self):
+        ''' Lateness of the ticks since playback started, in milliseconds '''
+        return {
+            'ticks': self.ticks,
+            'mean_late_ms': self.totalLate / max(1, self.ticks) / 1e6,
+            'max_late_ms': self.maxLate / 1e6,
+        }
+
+
+# EOF
@@ -2,12 +2,20 @@
 #pylint: disable=invalid-name,missing-docstring
 
 import json
+import bisect
+import hashlib
+import functools
+import threading
 
 from copy import deepcopy
-from random import randint
+from contextlib import contextmanager
+from random import Random
+from itertools import count
 from collections import defaultdict
 
-from mido import MidiFile
+import numpy as np
+
+from mido import MidiFile, MidiTrack, MetaMessage
 from mido.frozen import FrozenMessage
 
 DEFAULT_META_DATA = {
@@ -43,13 +51,157 @@ DEFAULT_AI_PARAMS = {
     'prev_bars': None,
     'chord_mode': 0,
     'meta_data': None,
+    # None: new bars every time, otherwise the same bars are generated for the same seed
+    'seed': None,
 }
 
+TICKS_PER_BAR = 96
+
+# unique version numbers of Measure MIDI events, used to detect changed bars
+MEASURE_VERSIONS = count()
+
+# Measure notes: pitch (0 for a pause), start and end ticks, and the velocity played with
+NOTE_DTYPE = np.dtype([
+    ('pitch', 'i2'),
+    ('start', 'i2'),
+    ('end', 'i2'),
+    ('velocity', 'u1'),
+])
+
 def forceListLength(l, length, alt=None):
     if len(l) > length:
         return l[:length]
     return l + [alt for _ in range(length - len(l))]
 
+def deriveSeed(*values):
+    ''' Returns a 32 bit seed from JSON serializable values, the same for the same values '''
+    key = json.dumps(values, sort_keys=True).encode('utf-8')
+    return int(hashlib.sha1(key).hexdigest()[:8], 16)
+
+
+def makeNoteArray(notes):
+    ''' NOTE_DTYPE array of a list of notes (nn, start_tick, end_tick), or of a
+    structured array with (at least) the pitch, start and end fields '''
+    array = np.zeros(len(notes), dtype=NOTE_DTYPE)
+    if getattr(notes, 'dtype', None) is not None and notes.dtype.names:
+        for name in ('pitch', 'start', 'end'):
+            array[name] = notes[name]
+    elif len(notes) > 0:
+        values = np.asarray(notes, dtype=np.int64).reshape(len(notes), -1)
+        array['pitch'] = values[:, 0]
+        array['start'] = values[:, 1]
+        array['end'] = values[:, 2]
+    return array
+
+
+# batch of the current thread, see batch()
+BATCHES = threading.local()
+
+# functions called with every batch once it has ended, see addChangeListener()
+CHANGE_LISTENERS = []
+
+
+class Batch():
+    '''
+    Changes made within batch(): the callbacks of the measures, sections and tracks
+    that changed are queued (each one at most once) instead of being called straight
+    away, and the changed measures and sections (and tracks whose layout changed)
+    are recorded.
+    '''
+
+    def __init__(self):
+        self.depth = 0
+        self.flushing = False
+
+        # {func: args} in the order they were first queued
+        self.pending = dict()
+        self.measures = set()
+        self.sections = set()
+        self.tracks = set()
+        # called with (measures, sections) once all queued callbacks have been called
+        self.listeners = []
+
+    def defer(self, func, *args):
+        self.pending[func] = args
+
+    def hasChanges(self):
+        return bool(self.pending or self.measures or self.sections or self.tracks)
+
+    def flush(self):
+        self.flushing = True
+        # (callbacks may queue more callbacks: measure -> section -> track -> engine)
+        while self.pending:
+            func = next(iter(self.pending))
+            args = self.pending.pop(func)
+            func(*args)
+
+        # (changes made by the listeners are collected in a batch of their own, which
+        # is flushed after them, so the listeners are called again with only those)
+        after = BATCHES.current = Batch()
+        after.depth = 1
+
+        for func in self.listeners:
+            func(self.measures, self.sections)
+
+        for func in list(CHANGE_LISTENERS):
+            func(self)
+
+        after.depth = 0
+        if after.hasChanges():
+            after.listeners = self.listeners + after.listeners
+        if after.hasChanges() or after.listeners:
+            after.flush()
+
+
+def getBatch():
+    ''' The batch of the current thread, or None if there is none '''
+    return getattr(BATCHES, 'current', None)
+
+
+@contextmanager
+def batch(callback=None):
+    ''' Collects the changes made within the context, and calls the callbacks of the
+    changed objects once, when the outermost batch ends. callback, if given, is then
+    called with the sets of changed measures and sections, and again with those
+    changed by the callbacks, if any '''
+    current = getBatch()
+    if current is None:
+        current = BATCHES.current = Batch()
+    if callback:
+        current.listeners.append(callback)
+
+    current.depth += 1
+    try:
+        yield current
+    finally:
+        current.depth -= 1
+        if current.depth == 0 and not current.flushing:
+            try:
+                current.flush()
+            finally:
+                BATCHES.current = None
+
+
+def addChangeListener(func):
+    ''' func is called with every Batch (of any thread) once its callbacks have been
+    called. Changes made outside batch() are in a batch of their own '''
+    CHANGE_LISTENERS.append(func)
+
+
+def removeChangeListener(func):
+    if func in CHANGE_LISTENERS:
+        CHANGE_LISTENERS.remove(func)
+
+
+def batched(method):
+    ''' Runs method within batch() '''
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        with batch():
+            return method(*args, **kwargs)
+    return wrapper
+
+
 def isJSONSerializable(x):
     try:
         json.dumps(x)
@@ -60,38 +212,70 @@ def isJSONSerializable(x):
 class Measure:
     '''
     Measure: Holds note values and associated times
+
+    Notes are kept in a NOTE_DTYPE array. The notes as played (with the octave
+    transpose and note length applied, and without pauses) and the MIDI events are
+    worked out when first needed and kept until the measure changes.
     '''
+    __slots__ = ('id_', 'chan', 'seed', 'transposeOctave', 'noteLength', 'velocityRange',
+                 'callbacks', 'noteArray', 'empty', 'noteList', 'playedArray', 'playedList',
+                 'midiEvents', 'version', 'genRequestSent', 'genEpoch')
+
     def __init__(self, id_, chan=1, notes=None, events=None,
-                 transpose_octave=0, note_length=None):
+                 transpose_octave=0, note_length=None, seed=None):
 
         self.id_ = id_
         self.chan = chan
+        # seed of the generated notes, also used for the velocities (None for random)
+        self.seed = seed
         self.transposeOctave = transpose_octave
         self.noteLength = note_length
         self.velocityRange = (80, 100)
 
         self.callbacks = set()
 
+        # cached results of the notes property, getPlayedArray(), getNotes() and
+        # getMidiEvents(), cleared whenever the measure changes
+        self.noteList = None
+        self.playedArray = None
+        self.playedList = None
+        self.midiEvents = None
+        self.version = next(MEASURE_VERSIONS)
+
         if notes is not None:
             # Note: (nn, start_tick, end_tick), where nn=0 is a pause. 96 ticks per measure (24 per beat)
-            self.notes = notes
-            #self.MidiEvents = self.convertNotesToMidiEvents(notes)
+            self.noteArray = makeNoteArray(notes)
+            self.setVelocityValues()
             self.empty = False
         elif events is not None:
             # {tick: [MIDI Events]} where MIDI Event = ('/eventType', (chan, nn, vel))
-            #self.MidiEvents = events
-            self.notes = self.convertMidiEventsToNotes(events)
+            self.noteArray = makeNoteArray(self.convertMidiEventsToNotes(events))
+            self.setVelocityValues()
             self.empty = False
         else:
             self.setEmpty()
 
         self.genRequestSent = False
+        # incremented with every generation request, so results of superseded
+        # (or cancelled) requests can be told apart and ignored
+        self.genEpoch = 0
+
+    @property
+    def notes(self):
+        ''' List of notes (nn, start_tick, end_tick) as generated (do not modify) '''
+        if self.noteList is None:
+            self.noteList = self.noteArray[['pitch', 'start', 'end']].tolist()
+        return self.noteList
 
     def call(self):
         ''' calls functions whenever notes are updated '''
         #print('[Measure]', 'updated')
-        for func in self.callbacks:
-            func()
+        self.clearMidiEvents()
+
+        with batch() as current:
+            current.measures.add(self)
+            for func in self.callbacks:
+                current.defer(func)
 
     def addCallback(self, func):
         self.callbacks.add(func)
@@ -100,17 +284,25 @@ class Measure:
         if func in self.callbacks:
             self.callbacks.remove(func)
 
+    def setVelocityValues(self):
+        ''' Sets the velocity of every note (other than pauses) within velocityRange '''
+        rand = Random(self.seed)
+        played = self.noteArray['pitch'] > 0
+        self.noteArray['velocity'][played] = [rand.randint(*self.velocityRange)
+                                              for _ in range(int(played.sum()))]
+
     def convertNotesToMidiEvents(self, notes):
-        ''' Returns dictionary {onTime: list of MIDI messages}. Messages do not contain time attribute.'''
+        ''' Returns dictionary {onTime: list of MIDI messages} of a NOTE_DTYPE array.
+        Messages do not contain time attribute.'''
         events = defaultdict(list)
-        for n in notes:
-            if n[0] > 0:
-                vel = randint(*self.velocityRange)
-                onMsg = FrozenMessage('note_on', channel=self.chan-1, note = n[0], velocity=vel)
-                offMsg = FrozenMessage('note_off', channel=self.chan-1, note = n[0], velocity=vel)
 
-                events[n[1]].append(onMsg)
-                events[n[2]].append(offMsg)
+        for nn, start, end, vel in notes.tolist():
+            if nn > 0:
+                onMsg = FrozenMessage('note_on', channel=self.chan-1, note=nn, velocity=vel)
+                offMsg = FrozenMessage('note_off', channel=self.chan-1, note=nn, velocity=vel)
+
+                events[start].append(onMsg)
+                events[end].append(offMsg)
 
         return dict(events)
 
@@ -144,30 +336,52 @@ class Measure:
     def isEmpty(self):
         return self.empty
 
-    def setNotes(self, notes):
-        self.notes = notes
-        #self.MidiEvents = self.convertNotesToMidiEvents(self.notes)
+    def setNotes(self, notes, seed=None):
+        self.noteArray = makeNoteArray(notes)
+        self.noteList = None
+        self.seed = seed
+        self.setVelocityValues()
         self.empty = False
         self.genRequestSent = False
         self.call()
 
+    def getPlayedArray(self):
+        ''' NOTE_DTYPE array of the actual played notes (includes transpose and length,
+        without pauses) '''
+        if self.playedArray is None:
+            played = self.noteArray[self.noteArray['pitch'] > 0]
+            played['pitch'] += 12*self.transposeOctave
+            if self.noteLength:
+                played['end'] = played['start'] + self.noteLength
+            self.playedArray = played
+        return self.playedArray
+
     def getNotes(self):
-        ''' Use this to access the actual played notes (includes transpose and length)'''
-        notes = []
-        for n in self.notes:
-            if n[0] > 0:
-                nn = n[0] + 12*self.transposeOctave
-                startTick = n[1]
-                if self.noteLength:
-                    endTick = startTick + self.noteLength
-                else:
-                    endTick = n[2]
-                notes.append((nn, startTick, endTick))
-        return notes
+        ''' Use this to access the actual played notes (includes transpose and length),
+        as a list of (nn, start_tick, end_tick) (do not modify) '''
+        if self.playedList is None:
+            self.playedList = self.getPlayedArray()[['pitch', 'start', 'end']].tolist()
+        return self.playedList
 
     def getMidiEvents(self):
         ''' Applies note length and velocity changes '''
-        return self.convertNotesToMidiEvents(self.getNotes())
+        if self.midiEvents is None:
+            self.midiEvents = self.convertNotesToMidiEvents(self.getPlayedArray())
+        return self.midiEvents
+
+    def clearMidiEvents(self):
+        ''' Clears the played notes and MIDI events, to be worked out again when needed '''
+        self.playedArray = None
+        self.playedList = None
+        self.midiEvents = None
+        self.version = next(MEASURE_VERSIONS)
+
+    def getMidiSpan(self):
+        ''' Number of bars the MIDI events reach over (note offs may overflow the measure) '''
+        played = self.getPlayedArray()
+        if len(played) == 0:
+            return 1
+        return int(max(played['start'].max(), played['end'].max())) // TICKS_PER_BAR + 1
 
     #def setMidiEvents(self, events):
     #    self.events = events
@@ -189,6 +403,8 @@ class Measure:
 
     def setVelocities(self, velocities):
         self.velocityRange = velocities
+        self.setVelocityValues()
+        self.clearMidiEvents()
 
     def setChan(self, chan):
         self.chan = chan
@@ -196,7 +412,8 @@ class Measure:
         #self.MidiEvents = self.getMidiEvents()
 
     def setEmpty(self):
-        self.notes = []
+        self.noteArray = makeNoteArray([])
+        self.noteList = None
         #self.MidiEvents = dict()
         self.empty = True
         self.call()
@@ -205,21 +422,34 @@ class Measure:
         data = {
             'id': self.id_,
             'empty': self.empty,
-            'notes': self.notes
+            'notes': self.notes,
+            'seed': self.seed
         }
 
         return data
 
     def __getstate__(self):
-        # in order to be picklable, must drop the callbacks...
-        state = self.__dict__.copy()
+        # in order to be picklable, must drop the callbacks (and cached views)...
+        state = {k: getattr(self, k) for k in self.__slots__}
         del state['callbacks']
+        for k in ('noteList', 'playedArray', 'playedList', 'midiEvents'):
+            state[k] = None
         return state
 
+    def __setstate__(self, state):
+        for k, v in state.items():
+            setattr(self, k, v)
+        self.callbacks = set()
+
 
 class Track:
     '''
     Track: an ordered list of Blocks
+
+    Blocks are indexed by their start bar (sorted, searched with bisect), so adding,
+    moving or deleting a block only places the blocks after it again, and a change
+    to a section only updates the blocks it is in (once per batch, see batch()).
+    flatMeasures is built from the index when first used after the layout changed.
     '''
     def __init__(self, instrument):
         ''' callback: function to call whenever self.track changes '''
@@ -227,16 +457,37 @@ class Track:
 
         # {bar number: block}
         self.track = dict()
-        # {blockID: [start times]}
+        # {blockID: start time}
         self.blocks = defaultdict(list)
 
-        self.flatMeasures = []
+        # start bars of the blocks in order, and the bar after the end of each block
+        self.starts = []
+        self.ends = []
+
+        # {section: {blockIDs of the blocks section is in}}, and the callback added to
+        # each section
+        self.sectionBlocks = defaultdict(set)
+        self.listeners = dict()
+
+        # cached list of the measure at every bar (None until needed)
+        self.flatCache = None
         self.callbacks = set()
 
+    @property
+    def flatMeasures(self):
+        ''' The measure at every bar (None where there is no block) '''
+        if self.flatCache is None:
+            flat = [None] * len(self)
+            for start_time, block in self.getBlocks():
+                flat[start_time:start_time+len(block.flatMeasures)] = block.flatMeasures
+            self.flatCache = flat
+        return self.flatCache
+
     def call(self):
         ''' execute functions when self.track if updated '''
-        for func in self.callbacks:
-            func(self.track)
+        with batch() as current:
+            for func in self.callbacks:
+                current.defer(func, self.track)
 
     def addCallback(self, func):
         self.callbacks.add(func)
@@ -262,23 +513,40 @@ class Track:
             #self.insertSection(len(self), section)
             #return
 
-        section.addCallback(self.flattenMeasures)
-
         id_ = self.getNextBlockID()
         block = Block(id_, [section])
+        self.addListener(section, id_)
 
+        i = bisect.bisect_left(self.starts, bar_num)
+        self.starts.insert(i, bar_num)
+        self.ends.insert(i, bar_num + len(block))
         self.track[bar_num] = block
         self.blocks[id_] = bar_num
-        self.flattenMeasures()
+
+        # (the block starts after the one before it ends, and pushes back the ones after)
+        bar_num = self.placeBlocks(i)
+        self.layoutChanged()
 
         return bar_num
 
     def deleteBlock(self, id_):
         print('[Track]', 'deleteBlock', id_)
-        start_time = self.blocks[id_]
-        del self.track[start_time]
-        del self.blocks[id_]
-        self.flattenMeasures()
+        self.removeBlock(id_)
+        self.layoutChanged()
+
+    def removeBlock(self, id_):
+        ''' Removes block id_ from the index (the blocks after it keep their place) '''
+        start_time = self.blocks.pop(id_)
+        block = self.track.pop(start_time)
+
+        i = bisect.bisect_left(self.starts, start_time)
+        del self.starts[i]
+        del self.ends[i]
+
+        for section in block.sections:
+            self.removeListener(section, id_)
+
+        return block
 
     def getNextBlockID(self):
         x = 0
@@ -293,62 +561,143 @@ class Track:
             print('[Track]', 'block at', from_, 'not found')
             return
 
-        del self.track[from_]
-
-        for section in block:
-            self.insertSection(to_, section)
+        with batch():
+            self.removeBlock(block.id_)
+            for section in block.sections:
+                self.insertSection(to_, section)
 
     def moveBlockTo(self, blockID, to_):
-        start = self.blocks[blockID][0]
-        self.moveSectionFromTo(start, to_)
-
-    def flattenMeasures(self):
-        ''' Recalculates all the start times '''
-        #print('[Track]', 'flatten measures')
-
-        new_blocks = defaultdict(list)
-        new_track = dict()
-        x = 0
+        start = self.blocks[blockID]
+        self.moveBlockFromTo(start, to_)
+
+    def placeBlocks(self, i=0, stopEarly=True):
+        ''' Moves the blocks from the i-th on to start no earlier than the end of the
+        block before them. Returns the start of the i-th block. If stopEarly, the blocks
+        after the i-th are assumed to be placed already '''
+        moved = []
+        x = self.ends[i-1] if i > 0 else 0
+        for j in range(i, len(self.starts)):
+            st = self.starts[j]
+            start_time = max(x, st)
+            if start_time == st and j > i and stopEarly:
+                # (neither this block nor those after it move)
+                break
 
-        #print(self.track.items())
-        for st in sorted(self.track.keys()):
             block = self.track[st]
-            start_time = max(x, st)
-            new_track[start_time] = block
-            new_blocks[block.id_] = start_time
-            x = start_time + len(block)
-            #print('Section', section.name, 'starts at', start_time)
+            if start_time != st:
+                moved.append((st, start_time, block))
+                self.starts[j] = start_time
 
-        self.track = new_track
-        self.blocks = new_blocks
-        self.flatMeasures = [None]*x
+            self.ends[j] = start_time + len(block)
+            x = self.ends[j]
 
-        for start_time, block in self.track.items():
-            for i, m in enumerate(block.flattenMeasures()):
-                self.flatMeasures[start_time+i] = m
+        # (a block may move to where the next block started)
+        for st, _, _ in moved:
+            del self.track[st]
+        for _, start_time, block in moved:
+            self.track[start_time] = block
+            self.blocks[block.id_] = start_time
 
-        #print(self.flatMeasures)
+        return self.starts[i] if i < len(self.starts) else None
 
-        self.call()
+    def flattenMeasures(self):
+        ''' Recalculates all the start times '''
+        #print('[Track]', 'flatten measures')
+        track = self.track
+        self.track = dict()
+        self.blocks = defaultdict(list)
+        self.starts = []
+        self.ends = []
+        self.sectionBlocks = defaultdict(set)
+
+        for st in sorted(track.keys()):
+            block = track[st]
+            block.flattenMeasures()
+            for section in block.sections:
+                self.addListener(section, block.id_)
+
+            self.track[st] = block
+            self.blocks[block.id_] = st
+            self.starts.append(st)
+            self.ends.append(st + len(block))
+
+        # (listeners of sections no longer in the track)
+        for section in set(self.listeners) - set(self.sectionBlocks):
+            section.removeCallback(self.listeners.pop(section))
+
+        if self.starts:
+            self.placeBlocks(0, stopEarly=False)
+
+        self.layoutChanged()
+
+    def addListener(self, section, blockID):
+        self.sectionBlocks[section].add(blockID)
+        if section not in self.listeners:
+            self.listeners[section] = lambda section=section: self.sectionChanged(section)
+            section.addCallback(self.listeners[section])
+
+    def removeListener(self, section, blockID):
+        self.sectionBlocks[section].discard(blockID)
+        if not self.sectionBlocks[section]:
+            del self.sectionBlocks[section]
+            section.removeCallback(self.listeners.pop(section))
+
+    def sectionChanged(self, section):
+        self.updateSections([section])
+
+    def updateSections(self, sections):
+        ''' Updates the blocks the sections are in, and places the blocks after any
+        block whose length changed again '''
+        layoutChanged = False
+        for section in sections:
+            for blockID in list(self.sectionBlocks.get(section, ())):
+                start_time = self.blocks[blockID]
+                block = self.track[start_time]
+
+                old = block.flatMeasures
+                if block.flattenMeasures() == old:
+                    # (only the notes of the measures changed)
+                    continue
+
+                layoutChanged = True
+                i = bisect.bisect_left(self.starts, start_time)
+                if self.ends[i] != start_time + len(block):
+                    self.ends[i] = start_time + len(block)
+                    if i + 1 < len(self.starts):
+                        self.placeBlocks(i + 1)
+
+        if layoutChanged:
+            self.layoutChanged()
+        else:
+            self.call()
+
+    def layoutChanged(self):
+        self.flatCache = None
+        with batch() as current:
+            current.tracks.add(self)
+            self.call()
 
     def measuresAt(self, n):
         ''' Returns None bars for n < 0 and n > length'''
         if isinstance(n, int):
-            if n < 0 or n >= len(self):
+            if self.flatCache is not None:
+                return self.flatCache[n] if 0 <= n < len(self.flatCache) else None
+            i = bisect.bisect_right(self.starts, n) - 1
+            if n < 0 or i < 0 or n >= self.ends[i]:
                 return None
-            return self.flatMeasures[n]
+            flat = self.track[self.starts[i]].flatMeasures
+            return flat[n - self.starts[i]]
         return [self.measuresAt(b) for b in n]
 
     def getBlocks(self):
-        return [(bar_num, self.track[bar_num]) for bar_num in sorted(self.track.keys())]
+        return [(bar_num, self.track[bar_num]) for bar_num in self.starts]
 
     def getNumberOfBlocks(self):
-        return len(self.track.keys())
+        return len(self.starts)
 
     def getSectionTimes(self, id_):
         ''' Returns the bar number of the first occurance of section ID '''
-
-        for st in sorted(self.track.keys()):
+        for st in self.starts:
             block = self.track[st]
             if block.sections[0].id_ == id_:
                 return st
@@ -356,9 +705,8 @@ class Track:
 
     def getLastSection(self):
         try:
-            bar_num = max(self.track.keys())
-            return self.track[bar_num].sections[-1]
-        except (ValueError, KeyError, IndexError):
+            return self.track[self.starts[-1]].sections[-1]
+        except (KeyError, IndexError):
             return None
 
     def getData(self):
@@ -369,29 +717,24 @@ class Track:
 
         data['blocks'] = dict(self.blocks)
 
-        for barNum, block in self.track.items():
+        # (copies, as the project may be changed by another thread meanwhile)
+        for barNum, block in list(self.track.items()):
             data['track'][barNum] = block.getData()
 
         return data
 
     def setData(self, trackData):
         self.track = dict()
-        self.blocks = defaultdict(list)
-
-        for bID, v in trackData['blocks'].items():
-            self.blocks[bID] = v
 
         for barNum, blockData in trackData['track'].items():
             sections = [self.instrument.sections[sID] for sID in blockData['sections']]
-            for s in sections:
-                s.addCallback(self.flattenMeasures)
             block = Block(int(blockData['id']), sections)
             self.track[int(barNum)] = block
 
         self.flattenMeasures()
 
     def __len__(self):
-        return len(self.flatMeasures)
+        return self.ends[-1] if self.ends else 0
 
     def __repr__(self):
         s = ['_' for _ in range(len(self))]
@@ -427,8 +770,10 @@ class SectionBase:
 
     def call(self):
         '''Call callback functions when parameters change'''
-        for func in self.callbacks:
-            func()
+        with batch() as current:
+            current.sections.add(self)
+            for func in self.callbacks:
+                current.defer(func)
 
     def addCallback(self, func):
         self.callbacks.add(func)
@@ -437,6 +782,7 @@ class SectionBase:
         if func in self.callbacks:
             self.callbacks.remove(func)
 
+    @batched
     def changeParameter(self, **kwargs):
         '''Change section parameters.'''
         #print('[SectionBase]', 'change parameters:')
@@ -508,13 +854,14 @@ class SectionBase:
         else:
             return True
 
-    def getData(self):
-        '''Returns a dictionary of section data, for saving as JSON.'''
+    def getData(self, measureIDs=None):
+        '''Returns a dictionary of section data, for saving as JSON. If measureIDs is
+        given, only the data of those measures is included.'''
         data = {
             'name': self.name,
             'id': self.id_,
             'type': self.type_,
-            'params': self.params,
+            'params': dict(self.params),
             'main_measures': [],
             'measures': dict(),
         }
@@ -525,8 +872,11 @@ class SectionBase:
             else:
                 data['main_measures'].append(None)
 
-        for mID, measure in self.measures.items():
-            data['measures'][mID] = measure.getData()
+        if measureIDs is None:
+            measureIDs = list(self.measures.keys())
+
+        for mID in measureIDs:
+            data['measures'][mID] = self.measures[mID].getData()
 
         return data
 
@@ -538,7 +888,8 @@ class SectionBase:
         self.measures = dict()
 
         for mID, mData in secData['measures'].items():
-            measure = Measure(mData['id'], notes=mData['notes'])
+            notes = None if mData.get('empty') else mData['notes']
+            measure = Measure(mData['id'], notes=notes, seed=mData.get('seed'))
             measure.addCallback(self.flattenMeasures)
             self.measures[int(mID)] = measure
 
@@ -578,6 +929,7 @@ class AISection(SectionBase):
         super().__init__(name, id_, **kwargs)
         self.type_ = 'ai'
 
+    @batched
     def changeParameter(self, **kwargs):
         super().changeParameter(**kwargs)
         # make sure looping lengths are all correct
@@ -626,8 +978,8 @@ class AISection(SectionBase):
         self.flatMeasures = track
         self.call()
 
-    def getData(self):
-        data = super().getData()
+    def getData(self, measureIDs=None):
+        data = super().getData(measureIDs)
 
         data['alt_ends'] = []
         for altEnd in self.altEnds:
@@ -799,12 +1151,21 @@ class Instrument:
         self.mute = False
         self.octave_transpose = 0
 
+        # {bar: versions of the measures in bar} when compileMidiPatch was last called
+        self.midiSignatures = dict()
+
     def measuresAt(self, n):
         if self.__len__() == 0:
             return None
 
         return self.track.measuresAt(n)
 
+    def batch(self):
+        ''' Context in which the changes to the instrument update the track (and call
+        its callbacks) once, at the end (see batch()) '''
+        return batch()
+
+    @batched
     def newSection(self, sectionType='ai', blank=False, **params):
         idx = self.sectionCount
         name = chr(65+idx) + str(self.id_)
@@ -833,35 +1194,97 @@ class Instrument:
         return bar_num, section
 
     def compileMidiMessages(self):
-        def addEvents(d, n, t, e):
-            if n not in events:
-                d[n] = dict()
-
-            if t not in events[n]:
-                d[n][t] = []
+        ''' Returns {bar: {tick: [MIDI messages]}} for the whole track '''
+        events = dict()
+        for n, sources in self.getMidiSources().items():
+            barEvents = self.compileBar(sources)
+            if barEvents:
+                events[n] = barEvents
 
-            d[n][t].extend(e)
+        return events
 
-        events = dict()
+    def compileMidiPatch(self, full=False):
+        ''' Returns {bar: {tick: [MIDI messages]}} of only the bars that changed since
+        the last call (an empty dictionary for bars that were cleared). If full, all
+        bars are returned '''
+        if full:
+            self.midiSignatures = dict()
+
+        sources = self.getMidiSources()
+        signatures = {n: tuple((offset, m.version) for offset, m in s)
+                      for n, s in sources.items()}
+
+        patch = dict()
+        for n in set(signatures) | set(self.midiSignatures):
+            if signatures.get(n) != self.midiSignatures.get(n):
+                patch[n] = self.compileBar(sources[n]) if n in sources else dict()
+
+        self.midiSignatures = signatures
+        return patch
+
+    def getMidiSources(self):
+        ''' Returns {bar: [(offset, measure)]}, the measures that have MIDI events in each
+        bar, where offset is the number of bars since the start of the measure '''
+        sources = defaultdict(list)
         for n, m in enumerate(self.track.flatMeasures):
             if m:
-                for t, e in m.getMidiEvents().items():
-                    if t >= 96:
-                        addEvents(events, n+(t//96), t%96, e)
-                    else:
-                        addEvents(events, n, t, e)
+                for offset in range(m.getMidiSpan()):
+                    sources[n+offset].append((offset, m))
 
-        return events
+        return sources
+
+    @staticmethod
+    def compileBar(sources):
+        events = defaultdict(list)
+        for offset, m in sources:
+            for t, e in m.getMidiEvents().items():
+                if t // TICKS_PER_BAR == offset:
+                    events[t % TICKS_PER_BAR].extend(e)
 
+        return dict(events)
+
+    def exportMidiTrack(self, global_transpose=0):
+        ''' Returns the whole track as a mido MidiTrack (24 ticks per beat), with octave
+        and global transposition applied '''
+        track = MidiTrack()
+
+        events = []
+        for n, m in enumerate(self.track.flatMeasures):
+            if not m:
+                continue
+            for t, e in m.getMidiEvents().items():
+                for msg in e:
+                    events.append((n*TICKS_PER_BAR+t, msg))
+
+        # sort by time, then note off events
+        events.sort(key=lambda x: (x[0], x[1].type))
+
+        track.append(MetaMessage('track_name', name=self.name))
+        for i, e in enumerate(events):
+            msg = e[1]
+            if i > 0:
+                t = e[0] - events[i-1][0]
+            else:
+                t = e[0]
+
+            nn = msg.note + 12*self.octave_transpose + global_transpose
+            track.append(msg.copy(time=t, note=nn))
+
+        track.append(MetaMessage('end_of_track'))
+        return track
+
+    @batched
     def changeSectionParameters(self, id_, **newParams):
         self.sections[id_].changeParameter(**newParams)
         self.track.flattenMeasures()
 
+    @batched
     def changeChannel(self, newChan):
         self.chan = newChan
         for section in self.sections.values():
             section.changeParameter(chan=newChan)
 
+    @batched
     def requestGenerateMeasures(self, sectionID=None, gen_all=False):
         ''' Compiles and sends request for section to generate new bars.
         If no section ID is given, then apply to all sections'''
@@ -880,43 +1303,72 @@ class Instrument:
             print('[Instrument]', 'section', sectionID, 'is not AI')
             return
 
-        leadID = section.params.get('lead', -1)
+        # swap in pre-generated bars if there are any...
+        if gen_all and self.engine.useCandidate(self, section):
+            return
+
+        # (measures repeat in loops: only the first time each is played is generated)
+        requested = set()
 
         for i, m in enumerate(section.flatMeasures):
-            if not m:
+            if not m or m in requested:
                 #print(i, 'm == None')
                 continue
             if not gen_all and not m.isEmpty():
                 #print(i, 'not gen_all and not m.isEmpty()')
                 continue
-            if m.genRequestSent:
+            if m.genRequestSent and not gen_all:
                 #print(i, 'm.genRequestSent')
                 continue
 
-            m.setEmpty()
-            request = {**DEFAULT_SECTION_PARAMS, **DEFAULT_AI_PARAMS, **section.params}
-
-            if leadID and leadID >= 0:
-                leadBar = self.engine.measuresAt(leadID, sectionStart+i)
-            else:
-                leadBar = self.measuresAt(sectionStart+i-1)
+            requested.add(m)
 
-            request['lead_bar'] = leadBar
-            prev_bars = self.measuresAt(range(sectionStart+i-4, sectionStart+i))
-            request['prev_bars'] = prev_bars
+            m.setEmpty()
+            request, requires = self.makeRequest(section, sectionStart, i, m)
 
             measureAddress = (self.id_, section.id_, m.id_, )
-            requires = [b for b in ([leadBar] + request['prev_bars']) if b]
 
+            # (supersedes any earlier request for m that is still pending)
             m.genRequestSent = True
+            m.genEpoch += 1
 
             self.engine.addPendingRequest({
                 'request': request,
                 'requires': requires,
-                'measure_address': measureAddress})
+                'measure': m,
+                'measure_address': measureAddress,
+                'epoch': m.genEpoch})
 
             #print('[Instrument]', 'addedRequest', request)
 
+    def makeRequest(self, section, sectionStart, i, m, substitutes=None):
+        ''' Returns the request to generate measure m at position i of section (which
+        starts at bar sectionStart), and the measures it requires to have notes.
+        substitutes: optional {measure: measure} of bars to use as context instead '''
+        request = {**DEFAULT_SECTION_PARAMS, **DEFAULT_AI_PARAMS, **section.params}
+        if request['seed'] is not None:
+            # a different seed for each measure of the section
+            request['seed'] = deriveSeed(request['seed'], section.id_, m.id_)
+
+        leadID = section.params.get('lead', -1)
+        if leadID and leadID >= 0:
+            leadBar = self.engine.measuresAt(leadID, sectionStart+i)
+        else:
+            leadBar = self.measuresAt(sectionStart+i-1)
+
+        prev_bars = self.measuresAt(range(sectionStart+i-4, sectionStart+i))
+
+        if substitutes:
+            leadBar = substitutes.get(leadBar, leadBar)
+            prev_bars = [substitutes.get(b, b) for b in prev_bars]
+
+        request['lead_bar'] = leadBar
+        request['prev_bars'] = prev_bars
+
+        requires = [b for b in ([leadBar] + prev_bars) if b]
+
+        return request, requires
+
     def deleteBlock(self, id_):
         self.track.deleteBlock(id_)
 
@@ -930,13 +1382,14 @@ class Instrument:
             'chan': self.chan
         }
 
-        for id_, section in self.sections.items():
+        for id_, section in list(self.sections.items()):
             data['sections'][id_] = section.getData()
 
         data['track'] = self.track.getData()
 
         return data
 
+    @batched
     def setData(self, insData):
         self.id_ = int(insData['id'])
         self.name = insData['name']
@@ -737,6 +737,13 @@ class SectionParameters(QtWidgets.QFrame):
 
         sample_layout.addWidget(self.parameters['chord_mode'])
 
+        self.parameters['seed'] = QtWidgets.QSpinBox()
+        self.parameters['seed'].setRange(0, 2**31 - 1)
+        self.parameters['seed'].setSpecialValueText('random')
+        self.parameters['seed'].setToolTip("Seed of the generated bars: the same settings and seed give the same bars again (and are taken from the cache), 'random' (0) gives new bars every time")
+        self.parameters['seed'].valueChanged.connect(self.parameterChanged)
+        sample_layout.addWidget(self.parameters['seed'])
+
         return sample_box
 
     def injectionBox(self):
@@ -828,6 +835,8 @@ class SectionParameters(QtWidgets.QFrame):
         self._instrument = section_box.instrument
         self._section_name.setText(f'{self._instrument.name}: {self._section.name}')
 
+        self._engine.setSelectedSection(self._instrument.id_, self._section.id_)
+
         color = section_box.getSectionColor()
         style_sheet = f'background-color: rgba({color.red()},{color.green()},{color.blue()},255);'
         self._section_name.setStyleSheet(style_sheet)
@@ -844,6 +853,8 @@ class SectionParameters(QtWidgets.QFrame):
             elif k == 'lead':
                 index = self.parameters['lead'].findData(v)
                 self.parameters[k].setCurrentIndex(index)
+            elif k == 'seed':
+                self.parameters[k].setValue(v if v is not None else 0)
             else:
                 self.parameters[k].setValue(v)
 
@@ -942,6 +953,9 @@ class SectionParameters(QtWidgets.QFrame):
                 params[k] = v.value
             elif k == 'velocity_range':
                 params[k] = (v.left, v.right)
+            elif k == 'seed':
+                # (0 is shown as 'random')
+                params[k] = v.value() or None
             else:
                 params[k] = v.value()
                 #print(k, v.value())
@@ -0,0 +1,231 @@
+#pylint: disable=invalid-name,missing-docstring
+
+'''
+ == Autosave journal ==
+
+ The project is autosaved as a snapshot (a binary project file, see project.py) and
+ a journal of the changes made since, one JSON entry per line:
+
+   {'type': 'settings', 'global_settings': {...}}
+   {'type': 'instrument', 'instrument': {id, name, chan, mute, octave_transpose}}
+   {'type': 'section', 'instrument': id, 'section': section data, with only the
+                                                    measures that changed}
+   {'type': 'track', 'instrument': id, 'track': track data}
+
+ Entries are appended by a background thread. Once the journal has COMPACT_ENTRIES
+ entries a new snapshot is written and the journal started again. The first line of
+ the journal is the generation of the snapshot it belongs to, so a journal left
+ over from an earlier snapshot (after a crash while compacting) is not replayed.
+'''
+
+import os
+import json
+import uuid
+import queue
+import threading
+
+from project import saveProject, openProject, Project
+
+JOURNAL_SUFFIX = '.journal'
+
+# number of journal entries after which a new snapshot is written
+COMPACT_ENTRIES = 1000
+
+
+def hasAutosave(path):
+    return os.path.exists(path)
+
+
+def readJournal(fp):
+    ''' Returns the generation and the entries of the journal fp. A line that was
+    only partly written (when the program stopped) and any after it are ignored '''
+    try:
+        with open(fp, 'r') as f:
+            lines = f.readlines()
+    except FileNotFoundError:
+        return None, []
+
+    entries = []
+    for line in lines:
+        try:
+            entries.append(json.loads(line))
+        except ValueError:
+            break
+
+    if not entries:
+        return None, []
+
+    return entries[0].get('generation'), entries[1:]
+
+
+def applyEntry(data, entry):
+    ''' Applies a journal entry to project data (as made by Engine.getProjectData,
+    with the keys read from JSON) '''
+    instruments = data['instruments']
+
+    if entry['type'] == 'settings':
+        data['global_settings'].update(entry['global_settings'])
+        return
+
+    if entry['type'] == 'instrument':
+        insID = str(entry['instrument']['id'])
+        if insID not in instruments:
+            instruments[insID] = {'sections': dict(), 'track': {'blocks': dict(), 'track': dict()}}
+        instruments[insID].update(entry['instrument'])
+        return
+
+    insData = instruments.get(str(entry['instrument']))
+    if insData is None:
+        print('[ProjectJournal]', 'entry for unknown instrument', entry['instrument'])
+        return
+
+    if entry['type'] == 'section':
+        secData = entry['section']
+        old = insData['sections'].get(str(secData['id']))
+        if old is not None:
+            secData['measures'] = {**old['measures'], **secData['measures']}
+        insData['sections'] = {**insData['sections'], str(secData['id']): secData}
+
+    elif entry['type'] == 'track':
+        insData['track'] = entry['track']
+
+    else:
+        print('[ProjectJournal]', 'unknown entry', entry['type'])
+
+
+def recoverProject(path):
+    ''' Returns the Project autosaved at path: the snapshot, with the journal replayed '''
+    snapshot = openProject(path)
+
+    data = {
+        'global_settings': dict(snapshot.getGlobalSettings()),
+        'instruments': {insID: snapshot.getInstrumentData(insID)
+                        for insID in snapshot.getInstrumentIDs()},
+    }
+
+    generation, entries = readJournal(path + JOURNAL_SUFFIX)
+    if generation is not None and generation == snapshot.header.get('generation'):
+        for entry in entries:
+            applyEntry(data, entry)
+    else:
+        entries = []
+
+    print('[ProjectJournal]', 'recovered', path, 'with', len(entries), 'changes')
+    return Project(data)
+
+
+class ProjectJournal(threading.Thread):
+    '''
+    Writes the autosave snapshot and journal of a project in the background. Entries
+    are encoded when they are recorded, the snapshot data is encoded by the thread.
+    '''
+
+    def __init__(self, path, compact_entries=COMPACT_ENTRIES):
+        super(ProjectJournal, self).__init__(daemon=True)
+        self.path = path
+        self.journalPath = path + JOURNAL_SUFFIX
+        self.compactEntries = compact_entries
+
+        # lines to append, snapshot data, or None to stop
+        self.queue = queue.Queue()
+
+        # entries recorded since the last snapshot, and whether a snapshot is waiting
+        # to be written
+        self.entries = 0
+        self.compacting = False
+
+        self.journalFile = None
+
+        self.stats = {'entries': 0, 'snapshots': 0, 'bytes': 0}
+
+    def record(self, entry):
+        self.queue.put(json.dumps(entry))
+        self.entries += 1
+
+    def compact(self, data):
+        ''' Writes data (as made by Engine.getProjectData) as the new snapshot, and
+        starts the journal again '''
+        self.compacting = True
+        self.entries = 0
+        self.queue.put(data)
+
+    def needsCompaction(self):
+        return not self.compacting and self.entries >= self.compactEntries
+
+    def stop(self, timeout=None):
+        ''' Writes everything recorded so far, and stops the thread '''
+        self.queue.put(None)
+        self.join(timeout)
+
+    def run(self):
+        while True:
+            # (write all the entries waiting, then flush once)
+            items = [self.queue.get()]
+            while items[-1] is not None:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            try:
+                for item in items:
+                    if item is None:
+                        break
+                    elif isinstance(item, str):
+                        self.writeEntry(item)
+                    else:
+                        self.writeSnapshot(item)
+
+                if self.journalFile is not None:
+                    self.journalFile.flush()
+                    os.fsync(self.journalFile.fileno())
+
+            except OSError as e:
+                # (entries go on to the current journal until a snapshot is written)
+                print('[ProjectJournal]', 'autosave failed:', e)
+                self.compacting = False
+
+            if items[-1] is None:
+                break
+
+        if self.journalFile is not None:
+            self.journalFile.close()
+            self.journalFile = None
+
+    def writeEntry(self, line):
+        if self.journalFile is None:
+            # (no snapshot yet)
+            return
+        self.journalFile.write(line + '\n')
+        self.stats['entries'] += 1
+        self.stats['bytes'] += len(line) + 1
+
+    def writeSnapshot(self, data):
+        generation = uuid.uuid4().hex
+        saveProject(self.path, {**data, 'generation': generation})
+
+        # (the new journal replaces the old one only once it is complete)
+        if self.journalFile is not None:
+            self.journalFile.close()
+            self.journalFile = None
+
+        with open(self.journalPath + '.tmp', 'w') as f:
+            f.write(json.dumps({'generation': generation}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.journalPath + '.tmp', self.journalPath)
+
+        self.journalFile = open(self.journalPath, 'a')
+        self.compacting = False
+        self.stats['snapshots'] += 1
+
+    def discard(self):
+        ''' Deletes the snapshot and journal (once the thread has stopped) '''
+        for fp in (self.path, self.journalPath):
+            try:
+                os.remove(fp)
+            except FileNotFoundError:
+                pass
+
+
+# EOF
@@ -1,3 +1,4 @@
+import os
 import multiprocessing
 
 from fbs_runtime.application_context.PyQt5 import ApplicationContext
@@ -6,10 +7,14 @@ from PyQt5.QtCore import Qt
 
 from gui.elements import InstrumentPanel, TrackPanel, TimeView, SectionView
 from app import Engine
+from journal import hasAutosave
 
 
 APP_NAME = "musAIc v0.9.1"
 
+# the project is autosaved here, and can be recovered from here after a crash
+AUTOSAVE_PATH = os.path.join(os.path.expanduser('~'), '.musaic', 'autosave.mus')
+
 INS_PANEL_HEIGHT = 100
 TIMELINE_HEIGHT = 20
 
@@ -257,10 +262,22 @@ class MainWindow(QtWidgets.QMainWindow):
 
         self.updateCursor()
 
-        self.addInstrument()
+        if hasAutosave(AUTOSAVE_PATH) and QtWidgets.QMessageBox.question(
+                self, 'Recover project...',
+                'musAIc did not close properly. Recover the autosaved project?') == QtWidgets.QMessageBox.Yes:
+            self.engine.recoverAutosave(AUTOSAVE_PATH)
+            self.global_controls['bpm'].setValue(self.engine.bpm)
+            self.global_controls['transpose'].setValue(self.engine.global_transpose)
+            self._track_view.update()
+        else:
+            self.addInstrument()
+
+        self.engine.startAutosave(AUTOSAVE_PATH)
 
     def close(self):
         print('[MainWindow]', 'Closing...')
+        # (closed properly, so there is nothing to recover)
+        self.engine.stopAutosave(discard=True)
         self.engine.join(timeout=1)
 
     def showOptions(self):
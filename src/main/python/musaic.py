@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+#pylint: disable=invalid-name,missing-docstring
+
+'''
+ == musAIc command line ==
+
+   $ python src/main/python/musaic.py batch [options]
+
+ (the GUI is launched with main.py)
+'''
+
+import argparse
+import multiprocessing
+
+import batch_generate
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='musaic')
+    subparsers = parser.add_subparsers(dest='command')
+
+    batch = subparsers.add_parser('batch', help='generate songs in batch, without playback')
+    batch_generate.addArguments(batch)
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'batch':
+        batch_generate.run(args)
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    main()
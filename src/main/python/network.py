@@ -2,29 +2,54 @@
 #pylint: disable=invalid-name,missing-docstring
 
 import os
+import json
 import time
 import random
+import hashlib
 import multiprocessing
 from copy import deepcopy
 
 import pickle as pkl
 
 import numpy as np
-import numpy.random as rand
 
 from core import DEFAULT_SECTION_PARAMS, DEFAULT_AI_PARAMS, DEFAULT_META_DATA
+from cache import LRUCache, ResultCache
 
 RANDOM = 0
 VER_9 = 1
 EUROAI = 2
+NUMPY = 3
 
 PLAYER = 2
 
-if PLAYER != RANDOM:
+# Upper bound on requests run through the network in one forward pass, and the
+# time (in seconds) to wait for more requests to arrive before running a batch
+MAX_BATCH_SIZE = 16
+MAX_BATCH_WAIT = 0.01
+
+# Number of embedded meta data vectors to remember, and the number of decimals
+# meta data values are rounded to before embedding
+META_CACHE_SIZE = 256
+META_DATA_PRECISION = 3
+
+# Number of generated bars of seeded requests to remember in memory. Results can
+# also be kept in a sqlite file shared between runs (delete it if the networks change)
+RESULT_CACHE_SIZE = 1024
+
+if PLAYER in (VER_9, EUROAI):
     from v9.Nets.ChordNetwork import ChordNetwork
     from v9.Nets.MetaEmbeddingEuro import MetaEmbedding
     from v9.Nets.MetaPredictorEuro import MetaPredictor
     from v9.Nets.CombinedNetworkEuro import CombinedNetwork
+elif PLAYER == NUMPY:
+    # EUROAI networks without tensorflow, see numpy_network.py for exporting the weights
+    import numpy_network
+
+
+def getGenerator(seed=None):
+    ''' Random number generator for one request (seed None for a random one) '''
+    return np.random.default_rng(seed)
 
 
 class RandomPlayer():
@@ -33,21 +58,31 @@ class RandomPlayer():
         print('[RandomPlayer]', ' === Using RANDOM PLAYER for testing ===')
 
     def generateBar(self, **kwargs):
+        rand = random.Random(kwargs.get('seed'))
         notes = []
         for i in range(4):
-            note = (random.randint(60, 80), i*24, (i+1)*24)
+            note = (rand.randint(60, 80), i*24, (i+1)*24)
             notes.append(note)
 
         return notes
 
+    def generateBars(self, requests):
+        return [self.generateBar(**request) for request in requests]
+
 
 class NeuralNet():
 
-    def __init__(self, resources_path=None, init_callbacks=None):
+    def __init__(self, resources_path=None, init_callbacks=None, result_cache=None):
+        ''' result_cache: path of the sqlite file to store generated bars in (optional) '''
 
         print('[NeuralNet]', 'Initialising...')
         self.loaded = False
 
+        # {quantised meta data values: embedded meta data}
+        self.metaCache = LRUCache(META_CACHE_SIZE)
+        # {request key: notes}, only for requests with a seed
+        self.resultCache = ResultCache(RESULT_CACHE_SIZE, result_cache)
+
         startTime = time.time()
 
         if not resources_path:
@@ -55,12 +90,13 @@ class NeuralNet():
 
         if PLAYER == VER_9:
             trainingsDir = os.path.join(resources_path, 'v9_lead/')
-        elif PLAYER == EUROAI:
+        elif PLAYER in (EUROAI, NUMPY):
             trainingsDir = os.path.join(resources_path, 'euroAI/')
         else:
             raise('[NeuralNet] Unknown player initialised ({}). Aborting'.format(PLAYER))
 
-        print('\n[NeuralNet]', ' === Using {} ===\n'.format('VER9' if PLAYER == VER_9 else 'EUROAI'))
+        print('\n[NeuralNet]', ' === Using {} ===\n'.format({VER_9: 'VER9', EUROAI: 'EUROAI',
+                                                             NUMPY: 'EUROAI (NumPy)'}[PLAYER]))
 
         with open(os.path.join(trainingsDir, 'DataGenerator.conversion_params'), 'rb') as f:
             conversionParams = pkl.load(f)
@@ -69,12 +105,16 @@ class NeuralNet():
         for k, v in list(self.rhythmDict.items()):
             self.rhythmDict[v] = k
 
-        self.metaEmbedder = MetaEmbedding.from_saved_custom(os.path.join(trainingsDir, 'meta'))
-        metaPredictor = MetaPredictor.from_saved_custom(os.path.join(trainingsDir, 'meta'))
+        if PLAYER == NUMPY:
+            self.metaEmbedder, self.combinedNet, self.chordNet = numpy_network.load(
+                os.path.join(trainingsDir, numpy_network.NUMPY_WEIGHTS))
+        else:
+            self.metaEmbedder = MetaEmbedding.from_saved_custom(os.path.join(trainingsDir, 'meta'))
+            metaPredictor = MetaPredictor.from_saved_custom(os.path.join(trainingsDir, 'meta'))
 
-        weightsFolder = os.path.join(trainingsDir, 'weights')
-        self.combinedNet = CombinedNetwork.from_saved_custom(weightsFolder, metaPredictor,
-                                                             generation=True, compile_now=False)
+            weightsFolder = os.path.join(trainingsDir, 'weights')
+            self.combinedNet = CombinedNetwork.from_saved_custom(weightsFolder, metaPredictor,
+                                                                 generation=True, compile_now=False)
 
         self.vocabulary = {
             'rhythm': self.combinedNet.params['rhythm_net_params'][2],
@@ -88,13 +128,14 @@ class NeuralNet():
         for k, v in list(self.chordDict.items()):
             self.chordDict[v] = k
 
-        self.chordNet = ChordNetwork.from_saved_custom(os.path.join(trainingsDir, 'chord'),
-                                                       load_melody_encoder=True)
+        if PLAYER != NUMPY:
+            self.chordNet = ChordNetwork.from_saved_custom(os.path.join(trainingsDir, 'chord'),
+                                                           load_melody_encoder=True)
 
         # predict some junk data to fully initilise model...
         self.generateBar(**DEFAULT_SECTION_PARAMS, **DEFAULT_AI_PARAMS)
 
-        print('\n[NeuralNet]', 'Neural network loaded in', int(time.time() - startTime), 'seconds\n')
+        print('\n[NeuralNet]', 'Neural network loaded in', round(time.time() - startTime, 2), 'seconds\n')
 
         self.loaded = True
 
@@ -116,47 +157,173 @@ class NeuralNet():
             - 'injection_params'
             - 'meta_data'
             - 'octave'
+            - 'seed' (optional, the same seed gives the same bar)
         '''
+        return self.generateBars([{**kwargs, 'octave': octave}])[0]
+
+    def generateBars(self, requests):
+        ''' Generates one bar for each request (same keys as generateBar). Bars of
+        seeded requests are looked up in the result cache first, and the rest are
+        generated together. Returns list of notes for each request, in the same order. '''
+        keys = [self.requestKey(kwargs) for kwargs in requests]
+
+        results = [None] * len(requests)
+        missing = []
+        for i, key in enumerate(keys):
+            if key is not None:
+                notes = self.resultCache.get(key)
+                if notes is not None:
+                    results[i] = [tuple(note) for note in notes]
+                    continue
+            missing.append(i)
+
+        if missing:
+            generated = self.predictBars([requests[i] for i in missing])
+            for i, notes in zip(missing, generated):
+                results[i] = notes
+                if keys[i] is not None:
+                    self.resultCache.put(keys[i], notes)
+
+        return results
+
+    def requestKey(self, kwargs):
+        ''' Hash of everything the bar generated for the request depends on, or None if
+        the request has no seed (so gives a different bar every time) '''
+        if kwargs.get('seed') is None:
+            return None
+
+        def barNotes(measure):
+            if not measure or measure.isEmpty():
+                return None
+            return [list(note) for note in measure.notes]
+
+        key = {
+            'player': PLAYER,
+            'seed': kwargs['seed'],
+            'octave': kwargs.get('octave', 4),
+            'sample_mode': kwargs.get('sample_mode'),
+            'chord_mode': kwargs.get('chord_mode'),
+            'lead_mode': kwargs.get('lead_mode'),
+            'context_mode': kwargs.get('context_mode'),
+            'meta_data': self.metaDataValues(kwargs.get('meta_data')),
+        }
+
+        if kwargs.get('context_mode') == 'inject':
+            key['injection_params'] = kwargs.get('injection_params')
+        else:
+            key['prev_bars'] = [barNotes(b) for b in (kwargs.get('prev_bars') or [])[-4:]]
+
+        if kwargs.get('lead_mode'):
+            key['lead_bar'] = barNotes(kwargs.get('lead_bar'))
 
-        #print('[NeuralNet]', 'generateBar with params')
-        #for k, v in kwargs.items():
-        #    print('  ', k, v)
+        return hashlib.sha1(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
 
-        rhythmContexts, melodyContexts = self.getContexts(kwargs)
-        embeddedMetaData = self.embedMetaData(kwargs['meta_data'])
-        leadRhythm, leadMelody = self.getLead(kwargs, rhythmContexts, melodyContexts)
+    def predictBars(self, requests):
+        ''' Generates one bar for each request using a single forward pass of the
+        network. Returns list of notes for each request, in the same order. '''
+
+        #print('[NeuralNet]', 'generateBars for', len(requests), 'requests')
+
+        # each request samples from its own generator, so that its result only
+        # depends on its seed (and not on the other requests in the batch)
+        rngs = [getGenerator(kwargs.get('seed')) for kwargs in requests]
+
+        contexts = [self.getContexts(kwargs, rng) for kwargs, rng in zip(requests, rngs)]
+        leads = [self.getLead(kwargs, *context, rng=rng)
+                 for kwargs, context, rng in zip(requests, contexts, rngs)]
+
+        contextSize = len(contexts[0][0])
+        rhythmContexts = [np.concatenate([c[0][i] for c in contexts]) for i in range(contextSize)]
+        melodyContexts = np.concatenate([c[1] for c in contexts])
+        embeddedMetaData = self.embedMetaDataList([kwargs.get('meta_data') for kwargs in requests])
+        leadRhythm = np.concatenate([l[0] for l in leads])
+        leadMelody = np.concatenate([l[1] for l in leads])
 
         output = self.combinedNet.predict(x=[*rhythmContexts,
                                              melodyContexts,
                                              embeddedMetaData,
                                              leadRhythm,
-                                             leadMelody])
-
-        sampledRhythm, sampledMelody, sampledChords = self.sampleOutput(output, kwargs)
-
-        return self.convertContextToNotes(sampledRhythm[0],
-                                          sampledMelody[0],
-                                          sampledChords,
-                                          kwargs,
-                                          octave=octave)
-
-    def embedMetaData(self, metaData):
+                                             leadMelody],
+                                          batch_size=len(requests))
+
+        sampled = [self.sampleOutput([output[0][i:i+1], output[1][i:i+1]], kwargs, rngs[i])
+                   for i, kwargs in enumerate(requests)]
+
+        # chords for all bars are predicted together...
+        onsets = [self.getOnsets(s[0][0], s[1][0], kwargs) for s, kwargs in zip(sampled, requests)]
+        chordOutputs = self.predictChords(requests, [s[1][0] for s in sampled], onsets)
+
+        results = []
+        for i, kwargs in enumerate(requests):
+            sampledRhythm, sampledMelody, sampledChords = sampled[i]
+
+            results.append(self.convertContextToNotes(sampledRhythm[0],
+                                                      sampledMelody[0],
+                                                      sampledChords,
+                                                      kwargs,
+                                                      octave=kwargs.get('octave', 4),
+                                                      onsets=onsets[i],
+                                                      chordOutputs=chordOutputs[i],
+                                                      rng=rngs[i]))
+
+        return results
+
+    def metaDataValues(self, metaData):
+        ''' Meta data dictionary as tuple of values (rounded to META_DATA_PRECISION
+        decimals), in the order the networks expect '''
         if not metaData:
             metaData = DEFAULT_META_DATA
         values = []
-        #print('[NeuralNet]', 'embedMetaData:')
+        #print('[NeuralNet]', 'metaDataValues:')
         for k in sorted(metaData.keys()):
             #print(k, metaData[k])
             if k == 'ts':
                 values.extend([4, 4])
             else:
-                values.append(metaData[k])
+                values.append(round(float(metaData[k]), META_DATA_PRECISION))
+
+        return tuple(values)
+
+    def embedMetaData(self, metaData):
+        return self.embedMetaDataList([metaData])
+
+    def embedMetaDataList(self, metaDataList):
+        ''' Embeds each meta data dictionary, only running the network for the ones
+        not found in the cache '''
+        keys = [self.metaDataValues(metaData) for metaData in metaDataList]
+
+        embedded = dict()
+        missing = []
+        for key in keys:
+            if key in embedded or key in missing:
+                continue
+            value = self.metaCache.get(key)
+            if value is None:
+                missing.append(key)
+            else:
+                embedded[key] = value
+
+        if missing:
+            #print('[NeuralNet]', 'embedding', len(missing), 'new meta data')
+            output = self.metaEmbedder.predict(np.array(missing))
+            for key, value in zip(missing, output):
+                self.metaCache.put(key, value)
+                embedded[key] = value
+
+        return np.array([embedded[key] for key in keys])
 
-        md = np.tile(values, (1, 1))
+    def getStats(self):
+        metaStats = self.metaCache.getStats()
+        resultStats = self.resultCache.getStats()
+        return {'meta_cache_hits': metaStats['hits'],
+                'meta_cache_misses': metaStats['misses'],
+                'result_cache_hits': resultStats['hits'],
+                'result_cache_misses': resultStats['misses']}
 
-        return self.metaEmbedder.predict(md)
+    def getContexts(self, kwargs, rng=None):
+        if rng is None:
+            rng = getGenerator(kwargs.get('seed'))
 
-    def getContexts(self, kwargs):
         mode = kwargs.get('context_mode', None)
         injection_params = kwargs.get('injection_params',
                                       DEFAULT_AI_PARAMS['injection_params'])
@@ -178,7 +345,7 @@ class NeuralNet():
                            self.rhythmDict[(0.3333, 0.6667)]]*2,
                 }[rhythmType])
 
-            rhythmContexts = [np.random.choice(rhythmPool, size=(1, 4)) for _ in range(4)]
+            rhythmContexts = [rng.choice(rhythmPool, size=(1, 4)) for _ in range(4)]
 
             melodyPool = {
                 'maj': [1, 3, 5, 6, 8, 10, 12],
@@ -189,13 +356,13 @@ class NeuralNet():
             #if len(injection_params) > 2 and injection_params[2]:
             melodyPool.extend([x+12 for x in melodyPool])
 
-            melodyContexts = np.random.choice(melodyPool, size=(1, 4, 48))
+            melodyContexts = rng.choice(melodyPool, size=(1, 4, 48))
 
         else:
             rhythmContexts = np.zeros((4, 1, 4))
             melodyContexts = np.zeros((1, 4, 48))
             for i, b in enumerate(prev_bars[-4:]):
-                r, m = self.convertBarToContext(b)
+                r, m = self.convertBarToContext(b, rng)
                 rhythmContexts[i, :, :] = r
                 melodyContexts[:, i, :] = m
 
@@ -203,19 +370,22 @@ class NeuralNet():
 
         return rhythmContexts, melodyContexts
 
-    def getLead(self, kwargs, rhythmContexts, melodyContexts):
+    def getLead(self, kwargs, rhythmContexts, melodyContexts, rng=None):
         if 'lead_mode' not in kwargs or not kwargs['lead_mode']:
             leadRhythm = rhythmContexts[-1]
             leadMelody = melodyContexts[:, -1:, :]
         elif kwargs['lead_mode'] == 'both':
-            leadRhythm, leadMelody = self.convertBarToContext(kwargs['lead_bar'])
+            leadRhythm, leadMelody = self.convertBarToContext(kwargs['lead_bar'], rng)
         elif kwargs['lead_mode'] == 'melody':
             leadRhythm = rhythmContexts[-1]
-            _, leadMelody = self.convertBarToContext(kwargs['lead_bar'])
+            _, leadMelody = self.convertBarToContext(kwargs['lead_bar'], rng)
 
         return leadRhythm, leadMelody
 
-    def sampleOutput(self, output, kwargs):
+    def sampleOutput(self, output, kwargs, rng=None):
+        if rng is None:
+            rng = getGenerator(kwargs.get('seed'))
+
         mode = kwargs.get('sample_mode', 'dist')
         chord_mode = kwargs.get('chord_mode', 1)
         if chord_mode in {'force', 'auto'}:
@@ -228,15 +398,15 @@ class NeuralNet():
         if mode == 'argmax' or mode == 'best':
             sampledRhythm = np.argmax(output[0], axis=-1)
             sampledMelody = np.argmax(output[1], axis=-1)
-            sampledChords = [list(rand.choice(self.vocabulary['melody'], p=curr_p,
-                                              size=chord_num, replace=True)) for curr_p in output[1][0]]
+            sampledChords = [list(rng.choice(self.vocabulary['melody'], p=curr_p,
+                                             size=chord_num, replace=True)) for curr_p in output[1][0]]
         elif mode == 'dist':
-            sampledRhythm = np.array([[np.random.choice(self.vocabulary['rhythm'], p=dist)
+            sampledRhythm = np.array([[rng.choice(self.vocabulary['rhythm'], p=dist)
                                        for dist in output[0][0]]])
-            sampledMelody = np.array([[np.random.choice(self.vocabulary['melody'], p=dist)
+            sampledMelody = np.array([[rng.choice(self.vocabulary['melody'], p=dist)
                                        for dist in output[1][0]]])
-            sampledChords = [list(rand.choice(self.vocabulary['melody'], p=curr_p, size=chord_num,
-                                           replace=True)) for curr_p in output[1][0]]
+            sampledChords = [list(rng.choice(self.vocabulary['melody'], p=curr_p, size=chord_num,
+                                             replace=True)) for curr_p in output[1][0]]
         elif mode == 'top':
             # Random from top 5 predictions....
             r = []
@@ -247,7 +417,7 @@ class NeuralNet():
                 r_probs = output[0][0][i][top5_rhythm_indices]
                 r_probs /= sum(r_probs)
 
-                r.append(rand.choice(top5_rhythm_indices, p=r_probs))
+                r.append(rng.choice(top5_rhythm_indices, p=r_probs))
 
             sampledRhythm = np.array([r])
             m = []
@@ -257,24 +427,26 @@ class NeuralNet():
                 m_probs = output[1][0][i][top5_m_indices]
                 m_probs /= sum(m_probs)
 
-                m.append(rand.choice(top5_m_indices, p=m_probs))
-                sampledChords.append(list(rand.choice(top5_m_indices, p=m_probs,
-                                                       replace=True, size=chord_num)))
+                m.append(rng.choice(top5_m_indices, p=m_probs))
+                sampledChords.append(list(rng.choice(top5_m_indices, p=m_probs,
+                                                     replace=True, size=chord_num)))
             sampledMelody = np.array([m])
 
         #print('[NeuralNet]', sampledRhythm.shape, sampledMelody.shape)
         return sampledRhythm, sampledMelody, sampledChords
 
-    def convertBarToContext(self, measure):
+    def convertBarToContext(self, measure, rng=None):
         '''
         Converts a list of notes (nn, start_tick, end_tick) to context
         format for network to use
         '''
+        if rng is None:
+            rng = getGenerator()
 
         if not measure or measure.isEmpty():
             # empty bar...
             rhythm = [self.rhythmDict[()] for _ in range(4)]
-            melody = [random.choice([1, 7]) for _ in range(48)]
+            melody = [rng.choice([1, 7]) for _ in range(48)]
             return np.array([rhythm]), np.array([[melody]])
 
         #print(measure.notes)
@@ -311,56 +483,22 @@ class NeuralNet():
 
         for j in range(48):
             if melody[j] == -1:
-                melody[j] = random.choice(pcs)
+                melody[j] = rng.choice(pcs)
 
         return np.array([rhythm]), np.array([[melody]])
 
-    def convertContextToNotes(self, rhythmContext, melodyContext,
-                              chordContexts, kwargs, octave=4):
-
-        def makeNote(pc, startTick, endTick):
-            nn = 12*(octave+1) + pc - 1
-            note = (int(nn), startTick, endTick)
-            return note
-
-        def predictChord(notes, pc, sample_mode, melodyContext, metaData, chord_mode='auto'):
-            values = []
-            for k in sorted(metaData.keys()):
-                if k == 'ts':
-                    values.extend([4, 4])
-                else:
-                    values.append(metaData[k])
-            md = np.tile(values, (1, 1))
-
-            chord_outputs = self.chordNet.predict(
-                x=[np.array([[pc]]), np.array([[melodyContext]]), md]
-            )
-            if sample_mode == 'dist' or sample_mode == 'top':
-                chord = rand.choice(len(chord_outputs[0]), p=chord_outputs[0])
-            else:
-                chord = np.argmax(chord_outputs[0], axis=-1)
-
-            intervals = self.chordDict[chord]
-            if chord_mode == 1:
-                intervals = [rand.choice(intervals)]
-            for interval in intervals:
-                notes.append(makeNote(pc+interval-12, tick, endTick))
-
-            return notes
-
-        if 'meta_data' not in kwargs or kwargs['meta_data'] == None:
-            kwargs['meta_data'] = deepcopy(DEFAULT_META_DATA)
-
-        notes = []
-        onTicks = [False] * 96
-
+    def getChordMode(self, kwargs):
         chord_mode = kwargs.get('chord_mode', 1)
         if chord_mode not in {'force', 'auto'}:
             chord_mode = int(chord_mode)
+        return chord_mode
 
-        #print('[NeuralNet]', 'convertContextToNotes', 'chord_mode', chord_mode)
-        sample_mode = kwargs.get('sample_mode', 'top')
+    def getOnsets(self, rhythmContext, melodyContext, kwargs):
+        ''' Returns list of (startTick, endTick, pc, chordRoot) for each note of the bar,
+        where chordRoot is None if no chord is to be predicted for that note '''
+        chord_mode = self.getChordMode(kwargs)
 
+        onTicks = [False] * 96
         for i, beat in enumerate(rhythmContext):
             b = self.rhythmDict[beat]
             for onset in b:
@@ -368,6 +506,7 @@ class NeuralNet():
 
         startTicks = [i for i in range(96) if onTicks[i]]
 
+        onsets = []
         for i, tick in enumerate(startTicks):
             try:
                 endTick = startTicks[i+1]
@@ -375,15 +514,91 @@ class NeuralNet():
                 endTick = 96
             pc = melodyContext[i//2]
 
+            chordRoot = None
             if chord_mode == 'force':
-                tonic = 12 + (pc % 12)
-                notes = predictChord(notes, tonic, sample_mode, melodyContext, kwargs['meta_data'])
-            elif chord_mode in (0, 1, 'auto'):
-                if pc >= 12:
-                    # draw chord intervals...
-                    notes = predictChord(notes, pc, sample_mode, melodyContext, kwargs['meta_data'], chord_mode=chord_mode)
+                chordRoot = 12 + (pc % 12)
+            elif chord_mode in (0, 1, 'auto') and pc >= 12:
+                chordRoot = pc
+
+            onsets.append((tick, endTick, pc, chordRoot))
+
+        return onsets
+
+    def predictChords(self, requests, melodyContexts, onsets):
+        ''' Runs the chord network once for all chord roots of all the bars. Returns the
+        chord distributions for each bar, in the order of the roots in onsets '''
+        roots = []
+        melodies = []
+        metaData = []
+        counts = []
+
+        for kwargs, melodyContext, barOnsets in zip(requests, melodyContexts, onsets):
+            barRoots = [[onset[3]] for onset in barOnsets if onset[3] is not None]
+            values = self.metaDataValues(kwargs.get('meta_data'))
+
+            roots.extend(barRoots)
+            melodies.extend([[melodyContext]]*len(barRoots))
+            metaData.extend([values]*len(barRoots))
+            counts.append(len(barRoots))
+
+        if not roots:
+            return [[] for _ in onsets]
+
+        chordOutputs = self.chordNet.predict(x=[np.array(roots), np.array(melodies), np.array(metaData)],
+                                             batch_size=len(roots))
+
+        results = []
+        i = 0
+        for count in counts:
+            results.append(chordOutputs[i:i+count])
+            i += count
+
+        return results
+
+    def convertContextToNotes(self, rhythmContext, melodyContext, chordContexts, kwargs,
+                              octave=4, onsets=None, chordOutputs=None, rng=None):
+        if rng is None:
+            rng = getGenerator(kwargs.get('seed'))
+
+        def makeNote(pc, startTick, endTick):
+            nn = 12*(octave+1) + pc - 1
+            note = (int(nn), startTick, endTick)
+            return note
+
+        if 'meta_data' not in kwargs or kwargs['meta_data'] == None:
+            kwargs['meta_data'] = deepcopy(DEFAULT_META_DATA)
+
+        if onsets is None:
+            onsets = self.getOnsets(rhythmContext, melodyContext, kwargs)
+        if chordOutputs is None:
+            chordOutputs = self.predictChords([kwargs], [melodyContext], [onsets])[0]
+
+        notes = []
+
+        chord_mode = self.getChordMode(kwargs)
+
+        #print('[NeuralNet]', 'convertContextToNotes', 'chord_mode', chord_mode)
+        sample_mode = kwargs.get('sample_mode', 'top')
+
+        chordOutputs = iter(chordOutputs)
+
+        for i, (tick, endTick, pc, chordRoot) in enumerate(onsets):
+            if chordRoot is not None:
+                # draw chord intervals...
+                chordOutput = next(chordOutputs)
+                if sample_mode == 'dist' or sample_mode == 'top':
+                    chord = rng.choice(len(chordOutput), p=chordOutput)
                 else:
-                    notes.append(makeNote(pc, tick, endTick))
+                    chord = np.argmax(chordOutput, axis=-1)
+
+                intervals = self.chordDict[chord]
+                if chord_mode == 1:
+                    intervals = [rng.choice(intervals)]
+                for interval in intervals:
+                    notes.append(makeNote(chordRoot+interval-12, tick, endTick))
+
+            elif chord_mode in (0, 1, 'auto'):
+                notes.append(makeNote(pc, tick, endTick))
 
             else:
                 for chord_pc in chordContexts[i//2]:
@@ -392,52 +607,158 @@ class NeuralNet():
         return notes
 
 
+def loadNetwork(resources_path=None, init_callbacks=None, result_cache=None):
+    ''' Returns the network selected by PLAYER '''
+    if PLAYER in (VER_9, EUROAI, NUMPY):
+        return NeuralNet(resources_path=resources_path, init_callbacks=init_callbacks,
+                         result_cache=result_cache)
+    elif PLAYER == RANDOM:
+        return RandomPlayer()
+
+    raise ValueError('[NetworkEngine] Unknown player ({})'.format(PLAYER))
+
+
 class NetworkEngine(multiprocessing.Process):
 
-    def __init__(self, requestQueue, returnQueue, resources_path=None, init_callbacks=None):
+    def __init__(self, requestQueue, returnQueue, resources_path=None, init_callbacks=None,
+                 max_batch_size=MAX_BATCH_SIZE, max_batch_wait=MAX_BATCH_WAIT, worker_id=0,
+                 result_cache=None, transport=None, doorbell=None):
         super(NetworkEngine, self).__init__()
 
+        self.workerID = worker_id
+
         self.requestQueue = requestQueue
         self.returnQueue = returnQueue
         self.resources_path = resources_path
         self.init_callbacks = init_callbacks
+        self.maxBatchSize = max(1, max_batch_size)
+        self.maxBatchWait = max_batch_wait
+        self.resultCache = result_cache
+        # transport.SharedTransport shared with Engine (None to only use the queues)
+        self.transport = transport
+        # end of a Pipe written to after results (or a status) are returned
+        self.doorbell = doorbell
 
         self.stopRequest = multiprocessing.Event()
+        self.loaded = multiprocessing.Event()
 
         self.network = None
 
+        # counters from the network, shared with the parent process
+        self.stats = {
+            'meta_cache_hits': multiprocessing.Value('i', 0),
+            'meta_cache_misses': multiprocessing.Value('i', 0),
+            'result_cache_hits': multiprocessing.Value('i', 0),
+            'result_cache_misses': multiprocessing.Value('i', 0),
+        }
+
     def run(self):
         if not self.network:
-            if PLAYER == VER_9 or PLAYER == EUROAI:
-                self.network = NeuralNet(resources_path=self.resources_path,
-                                         init_callbacks=self.init_callbacks)
-            elif PLAYER == RANDOM:
-                self.network = RandomPlayer()
+            try:
+                self.network = loadNetwork(self.resources_path, self.init_callbacks, self.resultCache)
+            except Exception as e:
+                print('[NetworkEngine]', self.workerID, 'failed to load network:', e)
+                self.returnQueue.put({'status': 'failed', 'worker': self.workerID, 'error': str(e)})
+                self.ring()
+                return
+
+            print('[NetworkEngine]', self.workerID, 'network loaded')
 
-            print('[NetworkEngine]', 'network loaded')
+        self.loaded.set()
+        self.returnQueue.put({'status': 'loaded', 'worker': self.workerID})
+        self.ring()
 
         while not self.stopRequest.is_set():
+            requestMsgs = self.getRequests()
+            if not requestMsgs:
+                continue
+
+            #print('generating results for', len(requestMsgs), 'requests')
+            results = self.network.generateBars([msg['request'] for msg in requestMsgs])
+            #print('generated results')
+
+            for requestMsg, result in zip(requestMsgs, results):
+                # (other keys of the request message are returned as they are)
+                returnMsg = {k: v for k, v in requestMsg.items() if k != 'request'}
+                returnMsg['result'] = result
+                returnMsg['seed'] = requestMsg['request'].get('seed')
+                self.sendResult(returnMsg)
+
+            self.ring()
+
+            self.updateStats()
+
+    def getRequests(self):
+        ''' Blocks until a request arrives, then collects any others that arrive within
+        maxBatchWait seconds (up to maxBatchSize requests). A None in the queue stops
+        the worker (after the requests already collected) '''
+        requestMsg = self.receiveRequest()
+        if requestMsg is None:
+            self.stopRequest.set()
+            return []
+        #print('[NetworkEngine]', 'request recieved from', requestMsg['measure_address'])
+
+        requestMsgs = [requestMsg]
+        deadline = time.time() + self.maxBatchWait
+        while len(requestMsgs) < self.maxBatchSize:
             try:
-                requestMsg = self.requestQueue.get(timeout=1)
-                #print('[NetworkEngine]', 'request recieved from', requestMsg['measure_address'])
+                requestMsg = self.receiveRequest(timeout=max(0, deadline - time.time()))
             except multiprocessing.queues.Empty:
-                #print('no messages recieved yet')
-                continue
+                break
+
+            if requestMsg is None:
+                self.stopRequest.set()
+                break
+
+            requestMsgs.append(requestMsg)
 
-            #print('generating result...')
-            result = self.network.generateBar(**requestMsg['request'])
-            #print('generated result')
+        return requestMsgs
+
+    def receiveRequest(self, timeout=None):
+        ''' Next request message (None to stop), raises Empty after timeout seconds '''
+        if self.transport is not None:
+            return self.transport.getRequest(self.requestQueue, timeout)
+        return self.requestQueue.get(timeout=timeout)
+
+    def sendResult(self, returnMsg):
+        if self.transport is not None:
+            self.transport.sendResult(returnMsg, self.returnQueue)
+        else:
+            self.returnQueue.put(returnMsg)
 
-            self.returnQueue.put({'measure_address': requestMsg['measure_address'],
-                                  'result': result})
+    def ring(self):
+        ''' Tells Engine there are messages to collect '''
+        if self.doorbell is not None:
+            self.doorbell.send_bytes(b'1')
 
-            time.sleep(0.01)
+    def updateStats(self):
+        if not hasattr(self.network, 'getStats'):
+            return
+
+        for k, v in self.network.getStats().items():
+            if k in self.stats:
+                self.stats[k].value = v
+
+    def getStats(self):
+        ''' Counters of the network (such as cache hits and misses) '''
+        return {k: v.value for k, v in self.stats.items()}
 
     def isLoaded(self):
-        return self.network.loaded
+        return self.loaded.is_set()
 
-    def join(self, timeout=1):
+    def stop(self):
+        ''' Asks the worker to stop once it has finished its current batch '''
+        if self.stopRequest.is_set():
+            return
         self.stopRequest.set()
+        # wake the worker if it is waiting for a request
+        if self.transport is not None:
+            self.transport.sendRequest(None, self.requestQueue)
+        else:
+            self.requestQueue.put(None)
+
+    def join(self, timeout=1):
+        self.stop()
         super(NetworkEngine, self).join(timeout)
 
 
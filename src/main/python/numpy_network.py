@@ -0,0 +1,364 @@
+#pylint: disable=invalid-name,missing-docstring
+
+'''
+ == NumPy inference engine ==
+
+ Forward pass only versions of the networks used for generation (BarEmbedding,
+ RhythmNetwork, MelodyNetwork, MelodyEncoder, ChordNetwork and MetaEmbedding)
+ that do not need TensorFlow or Keras to run. The weights are read from a single
+ .npz file, created from a trained model with:
+
+   $ python numpy_network.py path/to/trainingsDir [path/to/network.npz]
+
+ which also checks the NumPy outputs against the Keras ones (exporting does need
+ TensorFlow and Keras installed).
+
+'''
+
+import os
+import sys
+import json
+
+import numpy as np
+
+NUMPY_WEIGHTS = 'network.npz'
+
+
+def softmax(x, axis=-1):
+    e = np.exp(x - np.max(x, axis=axis, keepdims=True))
+    return e / np.sum(e, axis=axis, keepdims=True)
+
+
+ACTIVATIONS = {
+    None: lambda x: x,
+    'linear': lambda x: x,
+    'relu': lambda x: np.maximum(x, 0),
+    'tanh': np.tanh,
+    'sigmoid': lambda x: 1 / (1 + np.exp(-x)),
+    'hard_sigmoid': lambda x: np.clip(0.2*x + 0.5, 0, 1),
+    'softmax': softmax,
+}
+
+
+class Embedding():
+    def __init__(self, weights, name):
+        self.embeddings = weights[name + '/embeddings']
+
+    def __call__(self, x):
+        return self.embeddings[np.asarray(x, dtype=int)]
+
+
+class Dense():
+    def __init__(self, weights, config, name):
+        self.kernel = weights[name + '/kernel']
+        self.bias = weights[name + '/bias']
+        self.activation = ACTIVATIONS[config[name]['activation']]
+
+    def __call__(self, x):
+        return self.activation(np.dot(x, self.kernel) + self.bias)
+
+
+class Conv1D():
+    ''' 'valid' padding, stride 1 '''
+    def __init__(self, weights, config, name):
+        self.kernel = weights[name + '/kernel']
+        self.bias = weights[name + '/bias']
+        self.activation = ACTIVATIONS[config[name]['activation']]
+
+    def __call__(self, x):
+        win = self.kernel.shape[0]
+        steps = x.shape[1] - win + 1
+        out = np.stack([sum(np.dot(x[:, t+j], self.kernel[j]) for j in range(win))
+                        for t in range(steps)], axis=1)
+        return self.activation(out + self.bias)
+
+
+class LSTM():
+    ''' Keras gate order (input, forget, cell, output) '''
+    def __init__(self, weights, config, name):
+        self.kernel = weights[name + '/kernel']
+        self.recurrentKernel = weights[name + '/recurrent_kernel']
+        self.bias = weights[name + '/bias']
+        self.units = self.recurrentKernel.shape[0]
+        self.activation = ACTIVATIONS[config[name]['activation']]
+        self.recurrentActivation = ACTIVATIONS[config[name]['recurrent_activation']]
+
+    def __call__(self, x, return_sequences=False):
+        u = self.units
+        h = np.zeros((x.shape[0], u), dtype=self.kernel.dtype)
+        c = np.zeros((x.shape[0], u), dtype=self.kernel.dtype)
+
+        xz = np.dot(x, self.kernel) + self.bias
+        outputs = []
+        for t in range(x.shape[1]):
+            z = xz[:, t] + np.dot(h, self.recurrentKernel)
+            i = self.recurrentActivation(z[:, :u])
+            f = self.recurrentActivation(z[:, u:2*u])
+            o = self.recurrentActivation(z[:, 3*u:])
+            c = f*c + i*self.activation(z[:, 2*u:3*u])
+            h = o*self.activation(c)
+            outputs.append(h)
+
+        if return_sequences:
+            return np.stack(outputs, axis=1)
+        return h
+
+
+class Bidirectional():
+    ''' merge_mode="concat", last outputs only '''
+    def __init__(self, weights, config, name):
+        self.forward = LSTM(weights, config, name + '/forward')
+        self.backward = LSTM(weights, config, name + '/backward')
+
+    def __call__(self, x):
+        return np.concatenate([self.forward(x), self.backward(x[:, ::-1])], axis=-1)
+
+
+class BarEmbedding():
+    def __init__(self, weights, config, name='bar_embedding'):
+        self.embed = Embedding(weights, name + '/embedding')
+        self.lstm = Bidirectional(weights, config, name + '/lstm')
+        self.out = Dense(weights, config, name + '/dense')
+
+    def __call__(self, bars):
+        return self.out(self.lstm(self.embed(bars)))
+
+
+class MelodyEncoder():
+    def __init__(self, weights, config, name):
+        self.conv = Conv1D(weights, config, name + '/conv')
+        self.lstm = LSTM(weights, config, name + '/lstm')
+
+    def __call__(self, melodies):
+        return self.lstm(self.conv(melodies))
+
+
+class MetaEmbedding():
+    def __init__(self, weights, config, name='meta_embedding'):
+        self.preprocess = Dense(weights, config, name + '/preprocess')
+        self.categorise = Dense(weights, config, name + '/categorise')
+
+    def predict(self, x, **kwargs):
+        return self.categorise(self.preprocess(np.asarray(x, dtype=np.float32)))
+
+
+class CombinedNetwork():
+    ''' Generation version of v9.Nets.CombinedNetworkEuro.CombinedNetwork '''
+    def __init__(self, weights, config):
+        self.params = config['params']
+        self.rhythmUseMeta = self.params['rhythm_net_params'][-1]
+        self.melodyUseMeta = self.params['melody_net_params'][-1]
+
+        self.barEmbedder = BarEmbedding(weights, config)
+        self.rhythmEncoder = LSTM(weights, config, 'rhythm_net/encoder_lstm')
+        self.rhythmDecoder = LSTM(weights, config, 'rhythm_net/dec_lstm')
+        self.rhythmOut = Dense(weights, config, 'rhythm_net/softmax_layer')
+
+        self.melodyEncoder = MelodyEncoder(weights, config, 'melody_net/encoder')
+        self.leadEncoder = MelodyEncoder(weights, config, 'melody_net/lead_encoder')
+        self.melodyDecoder = LSTM(weights, config, 'melody_net/dec_lstm')
+        self.melodyOut = Dense(weights, config, 'melody_net/softmax_layer')
+
+    def predict(self, x, **kwargs):
+        ''' x = [*rhythm_contexts, melody_contexts, meta_embedded, lead_rhythm, lead_melody] '''
+        *rhythmContexts, melodyContexts, metaEmbedded, leadRhythm, leadMelody = x
+        metaEmbedded = np.asarray(metaEmbedded, dtype=np.float32)
+
+        # rhythm...
+        embeddings = np.stack([self.barEmbedder(c) for c in rhythmContexts], axis=1)
+        encoded = self.rhythmEncoder(embeddings)
+        if self.rhythmUseMeta:
+            encoded = np.concatenate([encoded, metaEmbedded, self.barEmbedder(leadRhythm)], axis=-1)
+
+        barLength = np.shape(rhythmContexts[0])[-1]
+        repeated = np.repeat(encoded[:, np.newaxis, :], barLength, axis=1)
+        rhythmPreds = self.rhythmOut(self.rhythmDecoder(repeated, return_sequences=True))
+
+        # melody...
+        rhythmsEmbedded = self.barEmbedder(np.argmax(rhythmPreds, axis=-1))
+        melodyContexts = np.asarray(melodyContexts, dtype=np.float32)
+        leadMelody = np.asarray(leadMelody, dtype=np.float32)
+
+        processed = [self.melodyEncoder(melodyContexts), rhythmsEmbedded]
+        if self.melodyUseMeta:
+            processed.append(metaEmbedded)
+        processed.append(self.leadEncoder(leadMelody))
+        processed = np.concatenate(processed, axis=-1)
+
+        m = melodyContexts.shape[-1]
+        repeated = np.repeat(processed[:, np.newaxis, :], m, axis=1)
+        melodyPreds = self.melodyOut(self.melodyDecoder(repeated, return_sequences=True))
+
+        return [rhythmPreds, melodyPreds]
+
+
+class ChordNetwork():
+    def __init__(self, weights, config, name='chord_net'):
+        self.melodyEncoder = MelodyEncoder(weights, config, name + '/melody_encoder')
+        self.root = Dense(weights, config, name + '/root')
+        self.decode = Dense(weights, config, name + '/decode')
+        self.out = Dense(weights, config, name + '/preds')
+
+    def predict(self, x, **kwargs):
+        ''' x = [root_note, bar_melody, meta_data] '''
+        rootNote, melodyContext, metaData = (np.asarray(i, dtype=np.float32) for i in x)
+        concat = np.concatenate([self.root(rootNote),
+                                 self.melodyEncoder(melodyContext),
+                                 metaData], axis=-1)
+        return self.out(self.decode(concat))
+
+
+def load(fp):
+    ''' Returns (MetaEmbedding, CombinedNetwork, ChordNetwork) from exported .npz '''
+    with np.load(fp) as data:
+        weights = {k: data[k] for k in data.files if k != 'config'}
+        config = json.loads(str(data['config']))
+
+    return MetaEmbedding(weights, config), CombinedNetwork(weights, config), ChordNetwork(weights, config)
+
+
+# --- Exporting from Keras ------------------------------------------------------
+
+def exportWeights(trainingsDir, fp=None):
+    ''' Saves the weights of the Keras networks in trainingsDir to a single .npz '''
+    from keras.layers import LSTM as KerasLSTM, Dense as KerasDense, Embedding as KerasEmbedding,\
+                             Conv1D as KerasConv1D, Bidirectional as KerasBidirectional, TimeDistributed
+
+    from v9.Nets.ChordNetwork import ChordNetwork as KerasChordNetwork
+    from v9.Nets.MetaEmbeddingEuro import MetaEmbedding as KerasMetaEmbedding
+    from v9.Nets.MetaPredictorEuro import MetaPredictor
+    from v9.Nets.CombinedNetworkEuro import CombinedNetwork as KerasCombinedNetwork
+    from v9.Nets.RhythmEncoder import RhythmEncoder
+    from v9.Nets.MelodyEncoder import MelodyEncoder as KerasMelodyEncoder
+
+    if not fp:
+        fp = os.path.join(trainingsDir, NUMPY_WEIGHTS)
+
+    weights = dict()
+    config = dict()
+
+    def layersOf(model, layerType):
+        return [l for l in model.layers if isinstance(l, layerType)]
+
+    def addLayer(name, layer, names):
+        for n, w in zip(names, layer.get_weights()):
+            weights[name + '/' + n] = w
+        layerConfig = layer.get_config()
+        config[name] = {k: layerConfig.get(k) for k in ('activation', 'recurrent_activation')}
+
+    def addLSTM(name, layer):
+        addLayer(name, layer, ('kernel', 'recurrent_kernel', 'bias'))
+
+    def addDense(name, layer):
+        addLayer(name, layer, ('kernel', 'bias'))
+
+    def addMelodyEncoder(name, encoder):
+        addDense(name + '/conv', layersOf(encoder, KerasConv1D)[0])
+        addLSTM(name + '/lstm', layersOf(encoder, KerasLSTM)[0])
+
+    metaDir = os.path.join(trainingsDir, 'meta')
+    metaEmbedder = KerasMetaEmbedding.from_saved_custom(metaDir)
+    metaPredictor = MetaPredictor.from_saved_custom(metaDir)
+    combinedNet = KerasCombinedNetwork.from_saved_custom(os.path.join(trainingsDir, 'weights'),
+                                                         metaPredictor, generation=True,
+                                                         compile_now=False)
+    chordNet = KerasChordNetwork.from_saved_custom(os.path.join(trainingsDir, 'chord'),
+                                                   load_melody_encoder=True)
+
+    config['params'] = combinedNet.params
+
+    # BarEmbedding
+    barEmbedder = combinedNet.bar_embedder
+    weights['bar_embedding/embedding/embeddings'] = layersOf(barEmbedder, KerasEmbedding)[0].get_weights()[0]
+    bidirectional = layersOf(barEmbedder, KerasBidirectional)[0]
+    addLSTM('bar_embedding/lstm/forward', bidirectional.forward_layer)
+    addLSTM('bar_embedding/lstm/backward', bidirectional.backward_layer)
+    addDense('bar_embedding/dense', layersOf(barEmbedder, KerasDense)[0])
+
+    # RhythmNetwork
+    rhythmNet = combinedNet.rhythm_net
+    rhythmEncoder = layersOf(rhythmNet, RhythmEncoder)[0]
+    addLSTM('rhythm_net/encoder_lstm', layersOf(rhythmEncoder, KerasLSTM)[0])
+    addLSTM('rhythm_net/dec_lstm', rhythmNet.get_layer('dec_lstm'))
+    addDense('rhythm_net/softmax_layer', rhythmNet.get_layer('softmax_layer').layer)
+
+    # MelodyNetwork
+    melodyNet = combinedNet.melody_net
+    leadEncoder = [l for l in layersOf(melodyNet, KerasMelodyEncoder) if l is not melodyNet.encoder][0]
+    addMelodyEncoder('melody_net/encoder', melodyNet.encoder)
+    addMelodyEncoder('melody_net/lead_encoder', leadEncoder)
+    addLSTM('melody_net/dec_lstm', layersOf(melodyNet, KerasLSTM)[0])
+    addDense('melody_net/softmax_layer', layersOf(melodyNet, TimeDistributed)[0].layer)
+
+    # ChordNetwork (the output layer is the softmax one, the root is encoded from a
+    # single input)
+    addMelodyEncoder('chord_net/melody_encoder', chordNet.melody_encoder)
+    for layer in layersOf(chordNet, KerasDense):
+        if layer.get_config()['activation'] == 'softmax':
+            addDense('chord_net/preds', layer)
+        elif layer.get_weights()[0].shape[0] == 1:
+            addDense('chord_net/root', layer)
+        else:
+            addDense('chord_net/decode', layer)
+
+    # MetaEmbedding
+    for layer in layersOf(metaEmbedder, KerasDense):
+        if layer.get_config()['activation'] == 'softmax':
+            addDense('meta_embedding/categorise', layer)
+        else:
+            addDense('meta_embedding/preprocess', layer)
+
+    np.savez(fp, config=np.array(json.dumps(config)), **weights)
+    print('[numpy_network]', 'saved weights to', fp)
+
+    return (metaEmbedder, combinedNet, chordNet), fp
+
+
+def verifyExport(kerasNets, fp, n=16, atol=1e-4):
+    ''' Compares outputs of the Keras networks and the NumPy networks on random inputs '''
+    numpyNets = load(fp)
+    params = numpyNets[1].params
+    V_rhythm = params['bar_embed_params'][0]
+    V_melody = params['melody_net_params'][3]
+    m = params['melody_bar_len']
+    metaLen = numpyNets[0].preprocess.kernel.shape[0]
+
+    rhythmContexts = [np.random.randint(0, V_rhythm, size=(n, 4))
+                      for _ in range(params['context_size'])]
+    melodyContexts = np.random.randint(1, V_melody, size=(n, params['context_size'], m))
+    meta = np.random.uniform(0, 10, size=(n, metaLen))
+    metaEmbedded = kerasNets[0].predict(meta)
+    leadRhythm = np.random.randint(0, V_rhythm, size=(n, 4))
+    leadMelody = np.random.randint(1, V_melody, size=(n, 1, m))
+    combinedInputs = [*rhythmContexts, melodyContexts, metaEmbedded, leadRhythm, leadMelody]
+
+    chordInputs = [np.random.randint(12, 24, size=(n, 1)),
+                   np.random.randint(1, V_melody, size=(n, 1, m)),
+                   meta]
+
+    comparisons = {
+        'meta_embedding': ([kerasNets[0].predict(meta)], [numpyNets[0].predict(meta)]),
+        'combined_net': (kerasNets[1].predict(combinedInputs), numpyNets[1].predict(combinedInputs)),
+        'chord_net': ([kerasNets[2].predict(chordInputs)], [numpyNets[2].predict(chordInputs)]),
+    }
+
+    ok = True
+    for name, (kerasOut, numpyOut) in comparisons.items():
+        err = max(np.max(np.abs(k - o)) for k, o in zip(kerasOut, numpyOut))
+        print('[numpy_network]', name, 'max abs error', err)
+        ok = ok and err <= atol
+
+    return ok
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('usage: python numpy_network.py trainingsDir [output.npz]')
+        sys.exit(1)
+
+    kerasNets, outputPath = exportWeights(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else None)
+    if not verifyExport(kerasNets, outputPath):
+        print('[numpy_network]', 'WARNING: NumPy outputs differ from Keras outputs')
+        sys.exit(1)
+
+# EOF
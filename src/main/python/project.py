@@ -0,0 +1,145 @@
+#pylint: disable=invalid-name,missing-docstring
+
+'''
+ == Project files (.mus) ==
+
+ Projects are saved either as JSON, or in a binary container:
+
+   MAGIC | header size (8 bytes, little endian) | JSON header | note arrays
+
+ The header holds the project as in the JSON files, except that the notes of each
+ measure are replaced by 'notes_at': [first row, number of rows] of the note array of
+ its instrument, and 'arrays' gives the position of each instrument's array
+ ([byte offset from the end of the header, number of rows]). Arrays start at
+ multiples of ALIGN bytes, so they can be memory-mapped, and are only read when the
+ instrument is loaded.
+'''
+
+import os
+import json
+import struct
+
+import numpy as np
+
+MAGIC = b'MUSAIC\x00\x01'
+ALIGN = 64
+
+# (nn, start_tick, end_tick) of the notes in the file
+FILE_NOTE_DTYPE = np.dtype([
+    ('pitch', '<i2'),
+    ('start', '<i2'),
+    ('end', '<i2'),
+])
+
+
+def align(n):
+    return -(-n // ALIGN) * ALIGN
+
+
+def saveProject(fp, data, binary=True):
+    ''' Saves the project data (as made by Engine.saveFile) to fp. The file is written
+    to a temporary file first, so a failed save leaves the old file as it was '''
+    with open(fp + '.tmp', 'wb') as f:
+        if binary:
+            writeBinaryProject(f, data)
+        else:
+            f.write(json.dumps(data, indent=4).encode('utf-8'))
+
+    os.replace(fp + '.tmp', fp)
+
+
+def writeBinaryProject(f, data):
+    # (other keys of data, such as the generation of autosave snapshots, are kept as they are)
+    header = {**data, 'instruments': dict(), 'arrays': dict()}
+    arrays = []
+    offset = 0
+
+    for insID, insData in data['instruments'].items():
+        notes = []
+        sections = dict()
+        for secID, secData in insData['sections'].items():
+            measures = dict()
+            for mID, mData in secData['measures'].items():
+                measures[mID] = {k: v for k, v in mData.items() if k != 'notes'}
+                measures[mID]['notes_at'] = [len(notes), len(mData['notes'])]
+                notes.extend(tuple(n) for n in mData['notes'])
+            sections[secID] = {**secData, 'measures': measures}
+
+        header['instruments'][insID] = {**insData, 'sections': sections}
+
+        array = np.array(notes, dtype=FILE_NOTE_DTYPE)
+        header['arrays'][insID] = [offset, len(array)]
+        arrays.append(array)
+        offset = align(offset + array.nbytes)
+
+    headerBytes = json.dumps(header).encode('utf-8')
+
+    f.write(MAGIC)
+    f.write(struct.pack('<Q', len(headerBytes)))
+    f.write(headerBytes)
+    f.write(bytes(align(f.tell()) - f.tell()))
+
+    for array in arrays:
+        f.write(array.tobytes())
+        f.write(bytes(align(array.nbytes) - array.nbytes))
+
+
+def openProject(fp):
+    ''' Returns the Project saved in fp, either binary or JSON '''
+    with open(fp, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            f.seek(0)
+            return Project(json.loads(f.read().decode('utf-8')))
+
+        size, = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(size).decode('utf-8'))
+
+    return Project(header, fp, align(len(MAGIC) + 8 + size))
+
+
+class Project():
+    '''
+    An opened project file. The data of an instrument (in the format of
+    Instrument.getData, with the notes as arrays for binary files) is only put
+    together when asked for.
+    '''
+
+    def __init__(self, header, path=None, dataStart=0):
+        self.header = header
+        # (None for JSON files, that have the notes in the header)
+        self.path = path
+        self.dataStart = dataStart
+
+    def getGlobalSettings(self):
+        return self.header['global_settings']
+
+    def getInstrumentIDs(self):
+        return list(self.header['instruments'].keys())
+
+    def getNotes(self, insID):
+        ''' Memory-mapped note array of instrument insID '''
+        offset, count = self.header['arrays'][insID]
+        if count == 0:
+            return np.zeros(0, dtype=FILE_NOTE_DTYPE)
+        return np.memmap(self.path, dtype=FILE_NOTE_DTYPE, mode='r',
+                         offset=self.dataStart+offset, shape=(count,))
+
+    def getInstrumentData(self, insID):
+        insData = self.header['instruments'][insID]
+        if self.path is None:
+            return insData
+
+        notes = self.getNotes(insID)
+
+        sections = dict()
+        for secID, secData in insData['sections'].items():
+            measures = dict()
+            for mID, mData in secData['measures'].items():
+                first, count = mData['notes_at']
+                measures[mID] = {**mData, 'notes': notes[first:first+count]}
+            sections[secID] = {**secData, 'measures': measures}
+
+        return {**insData, 'sections': sections}
+
+
+# EOF
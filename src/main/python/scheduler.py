@@ -0,0 +1,179 @@
+#pylint: disable=invalid-name,missing-docstring
+
+import threading
+from itertools import count
+from collections import defaultdict
+
+
+class RequestScheduler():
+    '''
+    Holds generation requests until all the measures they require have notes.
+
+    Pending requests are indexed by the measures they are waiting on, and a callback
+    on each of those measures releases exactly the requests that became ready when
+    the measure gets its notes.
+
+    Request messages are dictionaries with at least
+        - 'measure': the Measure the request generates
+        - 'requires': list of Measures that must not be empty before sending
+
+    There is at most one pending request per measure: adding a request replaces any
+    earlier one for the same measure.
+    '''
+
+    def __init__(self, readyCallback=None):
+        ''' readyCallback: called (with no arguments) whenever requests become ready '''
+        self.readyCallback = readyCallback
+
+        self.lock = threading.RLock()
+        self.counter = count()
+
+        # {requestID: request message}
+        self.pending = dict()
+        # {requestID: number of required measures that are still empty}
+        self.remaining = dict()
+        # {measure: {requestIDs waiting on measure}}
+        self.waiting = defaultdict(set)
+        # {measure: callback added to measure}
+        self.listeners = dict()
+        # requestIDs ready to be sent
+        self.ready = []
+        # {measure: requestID of the pending request generating measure}
+        self.requests = dict()
+
+    def addRequest(self, requestMsg):
+        with self.lock:
+            if requestMsg['measure'] in self.requests:
+                self.removeRequest(self.requests[requestMsg['measure']])
+
+            id_ = next(self.counter)
+            self.requests[requestMsg['measure']] = id_
+            requires = {m for m in requestMsg['requires'] if m.isEmpty()}
+
+            self.pending[id_] = requestMsg
+            self.remaining[id_] = len(requires)
+
+            for m in requires:
+                self.waiting[m].add(id_)
+                if m not in self.listeners:
+                    self.listeners[m] = lambda m=m: self.measureUpdated(m)
+                    m.addCallback(self.listeners[m])
+
+            if not requires:
+                self.ready.append(id_)
+
+        if not requires and self.readyCallback:
+            self.readyCallback()
+
+        return id_
+
+    def measureUpdated(self, measure):
+        ''' Releases requests waiting on measure, if it now has notes '''
+        if measure.isEmpty():
+            return
+
+        released = False
+        with self.lock:
+            if measure not in self.waiting:
+                return
+
+            measure.removeCallback(self.listeners.pop(measure))
+
+            for id_ in self.waiting.pop(measure):
+                self.remaining[id_] -= 1
+                if self.remaining[id_] == 0:
+                    self.ready.append(id_)
+                    released = True
+
+        if released and self.readyCallback:
+            self.readyCallback()
+
+    def downstream(self, measure, seen=None):
+        ''' Number of pending requests that (directly or indirectly) wait on measure '''
+        if seen is None:
+            seen = set()
+
+        n = 0
+        for id_ in self.waiting.get(measure, ()):
+            if id_ in seen:
+                continue
+            seen.add(id_)
+            n += 1 + self.downstream(self.pending[id_]['measure'], seen)
+
+        return n
+
+    def popReady(self, limit=None, priority=None):
+        ''' Removes and returns the ready requests (at most limit of them). They are ordered
+        by priority(requestMsg) if given (lowest first), then those that unblock the most
+        other requests first, then in the order they were added. Requests left over are
+        ordered again on the next call '''
+        with self.lock:
+            if not self.ready:
+                return []
+
+            downstream = {id_: self.downstream(self.pending[id_]['measure']) for id_ in self.ready}
+            if priority:
+                order = {id_: priority(self.pending[id_]) for id_ in self.ready}
+                ready = sorted(self.ready, key=lambda id_: (order[id_], -downstream[id_], id_))
+            else:
+                ready = sorted(self.ready, key=lambda id_: (-downstream[id_], id_))
+
+            if limit is not None:
+                ready, self.ready = ready[:limit], ready[limit:]
+            else:
+                self.ready = []
+
+            for id_ in ready:
+                del self.remaining[id_]
+                del self.requests[self.pending[id_]['measure']]
+
+            return [self.pending.pop(id_) for id_ in ready]
+
+    def removeRequest(self, id_):
+        ''' Removes a pending request (and the callbacks only it needed) and returns it '''
+        with self.lock:
+            requestMsg = self.pending.pop(id_)
+            del self.remaining[id_]
+            del self.requests[requestMsg['measure']]
+
+            if id_ in self.ready:
+                self.ready.remove(id_)
+
+            for m in requestMsg['requires']:
+                waiting = self.waiting.get(m)
+                if not waiting or id_ not in waiting:
+                    continue
+                waiting.discard(id_)
+                if not waiting:
+                    del self.waiting[m]
+                    m.removeCallback(self.listeners.pop(m))
+
+            return requestMsg
+
+    def cancel(self, predicate=None):
+        ''' Removes and returns the pending requests for which predicate(requestMsg) is
+        true (all of them if no predicate is given) '''
+        with self.lock:
+            ids = [id_ for id_, msg in self.pending.items() if predicate is None or predicate(msg)]
+            return [self.removeRequest(id_) for id_ in ids]
+
+    def hasReady(self):
+        return len(self.ready) > 0
+
+    def clear(self):
+        with self.lock:
+            for m, func in self.listeners.items():
+                m.removeCallback(func)
+
+            self.pending = dict()
+            self.remaining = dict()
+            self.waiting = defaultdict(set)
+            self.listeners = dict()
+            self.ready = []
+            self.requests = dict()
+
+    def __len__(self):
+        return len(self.pending)
+
+
+# EOF
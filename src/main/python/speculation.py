@@ -0,0 +1,140 @@
+#pylint: disable=invalid-name,missing-docstring
+
+import json
+import threading
+
+from core import Measure
+
+# Number of alternative versions of a section to keep ready
+SPECULATIVE_CANDIDATES = 3
+
+
+class CandidatePool():
+    '''
+    Alternative versions of all the measures of a section, generated ahead of time so
+    that regenerating the section can swap one in immediately.
+
+    Each candidate is generated bar by bar, in the same order as
+    Instrument.requestGenerateMeasures, with the candidate's own bars (held in stand-in
+    Measures) used as context where the section's bars would be. Candidates are
+    dropped as soon as the section's parameters, layout or context bars outside the
+    section change.
+    '''
+
+    def __init__(self, instrument, section, size=SPECULATIVE_CANDIDATES):
+        self.instrument = instrument
+        self.section = section
+        self.size = size
+
+        self.lock = threading.Lock()
+
+        # [{measureID: (notes, seed)}]
+        self.candidates = []
+        self.key = None
+
+        # candidate being generated: {measure: stand-in measure}, and the
+        # [(position in section, measure)] still to generate
+        self.chain = None
+        self.positions = []
+
+        # identifies the request waiting for a result (None if there is none)
+        self.token = 0
+        self.pending = None
+
+    def getKey(self):
+        ''' Everything the candidates depend on: the section's parameters, position and
+        layout, and the notes of the bars outside the section that are used as context '''
+        start = self.instrument.track.getSectionTimes(self.section.id_)
+        if start is None:
+            return None
+
+        own = set(self.section.measures.values())
+        context = []
+        for i, m in enumerate(self.section.flatMeasures):
+            if not m:
+                continue
+            _, requires = self.instrument.makeRequest(self.section, start, i, m)
+            context.extend(None if b.isEmpty() else b.notes for b in requires if b not in own)
+
+        layout = [m.id_ if m else None for m in self.section.flatMeasures]
+
+        return json.dumps([start, self.section.params, layout, context], sort_keys=True, default=str)
+
+    def validate(self):
+        ''' Drops all candidates if anything they depend on has changed '''
+        key = self.getKey()
+        if key == self.key:
+            return
+
+        with self.lock:
+            self.key = key
+            self.candidates = []
+            self.chain = None
+            self.pending = None
+
+    def isActive(self):
+        ''' Candidates are only generated for unseeded sections, as a seeded section
+        gives the same bars every time '''
+        return self.key is not None and self.section.params.get('seed') is None
+
+    def nextRequest(self):
+        ''' Returns (token, request) for the next bar to generate, or None if the pool
+        is full, a bar is already being generated, or a context bar is empty '''
+        with self.lock:
+            if not self.isActive() or self.pending is not None or len(self.candidates) >= self.size:
+                return None
+
+            start = self.instrument.track.getSectionTimes(self.section.id_)
+
+            if self.chain is None:
+                self.chain = dict()
+                self.positions = []
+                seen = set()
+                for i, m in enumerate(self.section.flatMeasures):
+                    if m and m not in seen:
+                        seen.add(m)
+                        self.positions.append((i, m))
+
+            if not self.positions:
+                self.chain = None
+                return None
+
+            i, m = self.positions[0]
+            request, requires = self.instrument.makeRequest(self.section, start, i, m,
+                                                            substitutes=self.chain)
+            if any(b.isEmpty() for b in requires):
+                return None
+
+            self.token += 1
+            self.pending = (self.token, m)
+            return self.token, request
+
+    def addResult(self, token, notes, seed=None):
+        with self.lock:
+            if self.pending is None or self.pending[0] != token:
+                # (the pool was reset since the request was sent)
+                return
+
+            _, m = self.pending
+            self.pending = None
+
+            self.chain[m] = Measure(m.id_, chan=m.chan, notes=notes, seed=seed)
+            self.positions.pop(0)
+
+            if not self.positions:
+                self.candidates.append({m.id_: (c.notes, c.seed) for m, c in self.chain.items()})
+                self.chain = None
+
+    def take(self):
+        ''' Removes and returns a candidate {measureID: (notes, seed)}, or None '''
+        self.validate()
+        with self.lock:
+            if not self.candidates:
+                return None
+            return self.candidates.pop(0)
+
+    def __len__(self):
+        return len(self.candidates)
+
+
+# EOF
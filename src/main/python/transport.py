@@ -0,0 +1,378 @@
+#pylint: disable=invalid-name,missing-docstring
+
+import json
+import multiprocessing
+import multiprocessing.queues
+
+import numpy as np
+
+from core import DEFAULT_META_DATA
+
+# Most notes a bar can have in a record (requests or results with longer bars are
+# sent pickled through the queue instead), and the size (bytes) of the JSON encoded
+# parameters of a request record
+MAX_NOTES = 128
+PARAMS_SIZE = 1024
+
+# Minimum number of records each ring buffer holds
+RING_SIZE = 256
+
+# the lead bar followed by (up to) 4 previous bars
+CONTEXT_BARS = 5
+
+# number of notes of a context bar that is None or empty
+NO_BAR = -2
+EMPTY_BAR = -1
+
+# kinds of request records
+REQUEST = 1
+QUEUED = 2
+
+# flags of the optional fields of a record
+HAS_ADDRESS = 1
+HAS_EPOCH = 2
+HAS_TOKEN = 4
+HAS_SEED = 8
+HAS_META = 16
+HAS_PREV_BARS = 32
+
+META_KEYS = sorted(k for k in DEFAULT_META_DATA if k != 'ts')
+
+NOTE_DTYPE = np.dtype([('pitch', 'i2'), ('start', 'i2'), ('end', 'i2')])
+
+# (fields common to requests and results: the message keys echoed back by the worker)
+ENVELOPE_FIELDS = [
+    ('flags', 'u1'),
+    ('address', 'i8', 3),
+    ('epoch', 'i8'),
+    ('token', 'i8'),
+    ('seed', 'i8'),
+]
+
+REQUEST_DTYPE = np.dtype([
+    ('kind', 'u1'),
+    *ENVELOPE_FIELDS,
+    ('meta', 'f8', len(META_KEYS)),
+    ('ts', 'S8'),
+    ('counts', 'i2', CONTEXT_BARS),
+    ('notes', NOTE_DTYPE, (CONTEXT_BARS, MAX_NOTES)),
+    ('params', 'S{}'.format(PARAMS_SIZE)),
+])
+
+RESULT_DTYPE = np.dtype([
+    *ENVELOPE_FIELDS,
+    ('count', 'i2'),
+    ('notes', NOTE_DTYPE, MAX_NOTES),
+])
+
+# keys of the messages that can be encoded
+REQUEST_KEYS = {'request', 'measure_address', 'epoch', 'speculative'}
+RESULT_KEYS = {'measure_address', 'epoch', 'speculative', 'result', 'seed'}
+
+
+class ContextBar():
+    '''
+    Notes of a context bar of a decoded request (stands in for core.Measure, with
+    only what the networks use)
+    '''
+    __slots__ = ('notes', 'empty')
+
+    def __init__(self, notes=None):
+        self.notes = notes or []
+        self.empty = notes is None
+
+    def isEmpty(self):
+        return self.empty
+
+
+def encodeEnvelope(msg, record):
+    flags = 0
+
+    address = msg.get('measure_address')
+    if address is not None:
+        record['address'] = address
+        flags |= HAS_ADDRESS
+
+    for key, field, flag in (('epoch', 'epoch', HAS_EPOCH), ('speculative', 'token', HAS_TOKEN)):
+        if msg.get(key) is not None:
+            record[field] = msg[key]
+            flags |= flag
+
+    return flags
+
+
+def decodeEnvelope(record):
+    flags = int(record['flags'])
+    return {
+        'measure_address': tuple(record['address'].tolist()) if flags & HAS_ADDRESS else None,
+        'epoch': int(record['epoch']) if flags & HAS_EPOCH else None,
+        'speculative': int(record['token']) if flags & HAS_TOKEN else None,
+    }
+
+
+def encodeNotes(notes, target):
+    ''' Writes notes (nn, start_tick, end_tick) to target, returns their number '''
+    if len(notes) > MAX_NOTES:
+        raise ValueError('too many notes')
+    for i, note in enumerate(notes):
+        target[i] = tuple(note)
+    return len(notes)
+
+
+def decodeNotes(notes, count):
+    return notes[:count].tolist()
+
+
+def encodeRequest(payload):
+    ''' Returns the request message (sent by Engine to the network) as a REQUEST_DTYPE
+    record, or None if it does not fit in one '''
+    if payload is None or not payload.keys() <= REQUEST_KEYS:
+        return None
+
+    request = dict(payload['request'])
+    record = np.zeros((), dtype=REQUEST_DTYPE)
+    record['kind'] = REQUEST
+
+    try:
+        flags = encodeEnvelope(payload, record)
+
+        seed = request.pop('seed', None)
+        if seed is not None:
+            record['seed'] = seed
+            flags |= HAS_SEED
+
+        metaData = request.get('meta_data')
+        if metaData and metaData.keys() == DEFAULT_META_DATA.keys():
+            record['meta'] = [metaData[k] for k in META_KEYS]
+            record['ts'] = metaData['ts'].encode('utf-8')
+            del request['meta_data']
+            flags |= HAS_META
+
+        bars = [request.pop('lead_bar', None)]
+        prev_bars = request.pop('prev_bars', None)
+        if prev_bars is not None:
+            if len(prev_bars) > CONTEXT_BARS - 1:
+                return None
+            bars.extend(prev_bars)
+            flags |= HAS_PREV_BARS
+
+        counts = record['counts']
+        counts[:] = NO_BAR
+        for i, bar in enumerate(bars):
+            if bar is None:
+                continue
+            if bar.isEmpty():
+                counts[i] = EMPTY_BAR
+            else:
+                counts[i] = encodeNotes(bar.notes, record['notes'][i])
+
+        params = json.dumps(request).encode('utf-8')
+        if len(params) > PARAMS_SIZE:
+            return None
+        record['params'] = params
+
+    except (TypeError, ValueError, OverflowError, AttributeError):
+        # (parameters that are not JSON serializable, or values that do not fit)
+        return None
+
+    record['flags'] = flags
+    return record[()]
+
+
+def decodeRequest(record):
+    ''' Returns the request message of a REQUEST_DTYPE record '''
+    flags = int(record['flags'])
+
+    request = json.loads(record['params'].decode('utf-8'))
+    request['seed'] = int(record['seed']) if flags & HAS_SEED else None
+
+    if flags & HAS_META:
+        metaData = dict(zip(META_KEYS, record['meta'].tolist()))
+        metaData['ts'] = record['ts'].decode('utf-8')
+        request['meta_data'] = metaData
+
+    bars = []
+    for i, count in enumerate(record['counts'].tolist()):
+        if count == NO_BAR:
+            bars.append(None)
+        elif count == EMPTY_BAR:
+            bars.append(ContextBar())
+        else:
+            bars.append(ContextBar(decodeNotes(record['notes'][i], count)))
+
+    request['lead_bar'] = bars[0]
+    request['prev_bars'] = bars[1:] if flags & HAS_PREV_BARS else None
+
+    return {'request': request, **decodeEnvelope(record)}
+
+
+def encodeResult(returnMsg):
+    ''' Returns the result message (sent by the network to Engine) as a RESULT_DTYPE
+    record, or None if it does not fit in one '''
+    if not returnMsg.keys() <= RESULT_KEYS:
+        return None
+
+    record = np.zeros((), dtype=RESULT_DTYPE)
+    try:
+        flags = encodeEnvelope(returnMsg, record)
+        if returnMsg.get('seed') is not None:
+            record['seed'] = returnMsg['seed']
+            flags |= HAS_SEED
+        record['count'] = encodeNotes(returnMsg['result'], record['notes'])
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+    record['flags'] = flags
+    return record[()]
+
+
+def decodeResult(record):
+    flags = int(record['flags'])
+    return {
+        **decodeEnvelope(record),
+        'result': decodeNotes(record['notes'], int(record['count'])),
+        'seed': int(record['seed']) if flags & HAS_SEED else None,
+    }
+
+
+def increment(value):
+    with value.get_lock():
+        value.value += 1
+
+
+class SharedRing():
+    '''
+    FIFO of fixed size records (of dtype) in a ring buffer in shared memory, that any
+    number of processes can put records in and get them from. Must be created before
+    the processes using it are started.
+    '''
+
+    def __init__(self, dtype, capacity=RING_SIZE):
+        self.dtype = np.dtype(dtype)
+        self.capacity = capacity
+
+        self.buffer = multiprocessing.RawArray('b', self.dtype.itemsize * capacity)
+        self.head = multiprocessing.RawValue('q', 0)
+        self.tail = multiprocessing.RawValue('q', 0)
+
+        self.lock = multiprocessing.Lock()
+        self.items = multiprocessing.Semaphore(0)
+        self.space = multiprocessing.Semaphore(capacity)
+
+        self.records = None
+
+    def getRecords(self):
+        # (view of the shared buffer, made in the process using it)
+        if self.records is None:
+            self.records = np.frombuffer(self.buffer, dtype=self.dtype)
+        return self.records
+
+    def put(self, record, block=True, timeout=None):
+        ''' Adds record, returns False if the ring stayed full '''
+        if not self.space.acquire(block, timeout):
+            return False
+
+        records = self.getRecords()
+        with self.lock:
+            records[self.tail.value % self.capacity] = record
+            self.tail.value += 1
+
+        self.items.release()
+        return True
+
+    def get(self, block=True, timeout=None):
+        ''' Removes and returns the oldest record (a copy), or None if there was none '''
+        if not self.items.acquire(block, timeout):
+            return None
+
+        records = self.getRecords()
+        with self.lock:
+            record = records[self.head.value % self.capacity].copy()
+            self.head.value += 1
+
+        self.space.release()
+        return record
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['records'] = None
+        return state
+
+
+class SharedTransport():
+    '''
+    Carries the requests from Engine to the network workers and their results back
+    as fixed size records in shared memory, instead of pickling them through the
+    queues. Messages that do not fit in a record (or do not fit in the ring) still
+    go through the queues:
+        - a request sent through the queue leaves a QUEUED record in the ring, so the
+          workers only have to wait on the ring, and take it from the queue in turn
+        - results can come from either, the doorbell is rung after results are put in
+          the ring (Engine waits on it together with the return queue)
+    '''
+
+    def __init__(self, capacity=RING_SIZE):
+        self.requests = SharedRing(REQUEST_DTYPE, capacity)
+        self.results = SharedRing(RESULT_DTYPE, capacity)
+        self.doorbellReader, self.doorbellWriter = multiprocessing.Pipe(duplex=False)
+
+        # number of messages sent through the shared memory, and through the queues
+        self.sent = multiprocessing.Value('q', 0)
+        self.fallbacks = multiprocessing.Value('q', 0)
+
+    def sendRequest(self, payload, queue):
+        ''' Sends a request message to the workers (None stops one worker) '''
+        record = encodeRequest(payload)
+        if record is not None and self.requests.put(record, block=False):
+            increment(self.sent)
+            return
+
+        queue.put(payload)
+        marker = np.zeros((), dtype=REQUEST_DTYPE)
+        marker['kind'] = QUEUED
+        self.requests.put(marker)
+        increment(self.fallbacks)
+
+    def getRequest(self, queue, timeout=None):
+        ''' Returns the next request message (None to stop). Raises queue Empty if
+        there is none within timeout seconds '''
+        record = self.requests.get(timeout=timeout)
+        if record is None:
+            raise multiprocessing.queues.Empty
+
+        if record['kind'] == QUEUED:
+            return queue.get()
+        return decodeRequest(record)
+
+    def sendResult(self, returnMsg, queue):
+        ''' Sends a result message to Engine (ring the doorbell afterwards) '''
+        record = encodeResult(returnMsg)
+        if record is not None and self.results.put(record, block=False):
+            increment(self.sent)
+            return
+
+        queue.put(returnMsg)
+        increment(self.fallbacks)
+
+    def ring(self):
+        self.doorbellWriter.send_bytes(b'1')
+
+    def getResults(self):
+        ''' Returns all result messages in the ring '''
+        # (clear the doorbell first, so results added meanwhile ring it again)
+        while self.doorbellReader.poll():
+            self.doorbellReader.recv_bytes()
+
+        results = []
+        while True:
+            record = self.results.get(block=False)
+            if record is None:
+                return results
+            results.append(decodeResult(record))
+
+    def getStats(self):
+        return {'shared_messages': self.sent.value,
+                'queued_messages': self.fallbacks.value}
+
+
+# EOF
@@ -0,0 +1,68 @@
+#pylint: disable=invalid-name,missing-docstring
+
+import unittest
+
+from core import Instrument, batch, addChangeListener, removeChangeListener
+
+
+class BatchListenerTest(unittest.TestCase):
+    ''' Changes made by the listeners of a batch call the callbacks of what changed,
+    as the same changes made outside a batch do '''
+
+    def setUp(self):
+        self.ins = Instrument(0, 'test', 1, None)
+        _, self.section = self.ins.newSection(length=2, loop_num=1)
+        self.m0, self.m1 = self.section.flatMeasures
+
+        self.tracks = []
+        self.ins.track.addCallback(self.tracks.append)
+        self.sections = []
+        self.section.addCallback(lambda: self.sections.append(self.section))
+
+        self.recorded = []
+        addChangeListener(self.record)
+
+    def tearDown(self):
+        removeChangeListener(self.record)
+
+    def record(self, changes):
+        self.recorded.append(set(changes.measures))
+
+    def test_listener_change(self):
+        seen = []
+
+        def listener(measures, sections):
+            seen.append(set(measures))
+            if self.m1 not in measures:
+                self.m1.setNotes([(60, 0, 24)])
+
+        with batch(listener):
+            self.m0.setNotes([(62, 0, 24)])
+
+        self.assertEqual(seen, [{self.m0}, {self.m1}])
+        self.assertEqual(self.recorded, [{self.m0}, {self.m1}])
+        self.assertEqual(len(self.sections), 2)
+        self.assertEqual(len(self.tracks), 2)
+        self.assertEqual(self.m1.getNotes(), [(60, 0, 24)])
+
+    def test_change_listener_change(self):
+        def listener(changes):
+            if self.m0 in changes.measures:
+                self.m1.setNotes([(60, 0, 24)])
+
+        addChangeListener(listener)
+        try:
+            self.m0.setNotes([(62, 0, 24)])
+        finally:
+            removeChangeListener(listener)
+
+        self.assertEqual(self.recorded, [{self.m0}, {self.m1}])
+        self.assertEqual(len(self.sections), 2)
+        self.assertEqual(len(self.tracks), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+
+# EOF